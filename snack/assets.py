@@ -0,0 +1,177 @@
+"""
+Static file serving with fingerprinted URLs and precompressed siblings\n
+static_url("/main.css") returns /static/main.<hash>.css, which is served with a year-long
+immutable Cache-Control, so repeat page views don't request it again. So are the resized image
+variants, which are already named by content hash. Any other static URL is revalidated against
+its ETag.
+Run `python -m snack.assets` after changing static files to build their .br and .gz siblings.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import stat
+import sys
+
+import brotli
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+from snack.images import STATIC_DIR, STATIC_URL, is_variant
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+# Files worth compressing, images other than SVG are already compressed
+COMPRESSIBLE = {".css", ".js", ".svg", ".html", ".json", ".txt", ".map", ".ico"}
+# Precompressed sibling suffix for each content-encoding, in order of preference
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+COMPRESSORS = {
+    ".br": lambda data: brotli.compress(data, quality=11),
+    ".gz": lambda data: gzip.compress(data, compresslevel=9, mtime=0),
+}
+
+DIGEST_LENGTH = 12
+_FINGERPRINTED = re.compile(
+    rf"^(?P<stem>.+)\.(?P<digest>[0-9a-f]{{{DIGEST_LENGTH}}})(?P<ext>\.[^./]+)$"
+)
+
+# {path: (mtime, digest)}
+_digests = {}
+
+
+def file_digest(path: str) -> str:
+    """Content hash of a file under the static directory, only recomputed when it's modified"""
+    full_path = os.path.join(STATIC_DIR, path.lstrip("/"))
+    mtime = os.stat(full_path).st_mtime_ns
+    cached = _digests.get(full_path)
+    if cached is None or cached[0] != mtime:
+        with open(full_path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:DIGEST_LENGTH]
+        cached = _digests[full_path] = (mtime, digest)
+    return cached[1]
+
+
+def static_url(path: str) -> str:
+    """Template helper resolving a file in the static directory to its fingerprinted URL"""
+    try:
+        digest = file_digest(path)
+    except FileNotFoundError:
+        return f"{STATIC_URL}/{path.lstrip('/')}"
+    stem, ext = os.path.splitext(path.lstrip("/"))
+    return f"{STATIC_URL}/{stem}.{digest}{ext}"
+
+
+def split_fingerprint(path: str) -> tuple[str, str]:
+    """Splits a fingerprinted path into the real path and its digest, which is None if absent"""
+    directory, name = os.path.split(path)
+    match = _FINGERPRINTED.match(name)
+    if match is None:
+        return path, None
+    return os.path.join(directory, match["stem"] + match["ext"]), match["digest"]
+
+
+def accepted_encodings(headers: Headers) -> set[str]:
+    encodings = set()
+    for item in headers.get("accept-encoding", "").split(","):
+        encoding, _, params = item.strip().partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            encodings.add(encoding.strip().lower())
+    return encodings
+
+
+def _is_file(stat_result: os.stat_result) -> bool:
+    return stat_result is not None and stat.S_ISREG(stat_result.st_mode)
+
+
+class StaticAssets(StaticFiles):
+    """
+    StaticFiles serving fingerprinted paths with immutable caching, and .br/.gz siblings built
+    by compress_static when the client accepts them
+    """
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        real_path, digest = split_fingerprint(path)
+        full_path, stat_result = await self.lookup_path(real_path)
+        if digest is not None and not _is_file(stat_result):
+            # The hash-like part is really in the filename
+            real_path, digest = path, None
+            full_path, stat_result = await self.lookup_path(path)
+        if not _is_file(stat_result):
+            return await super().get_response(path, scope)
+
+        response = await self.encoded_response(real_path, full_path, stat_result, scope)
+        if digest is None:
+            fresh = is_variant(real_path)
+        else:
+            # A stale hash from an old page gets the current file, which mustn't be cached for good
+            fresh = digest == file_digest(real_path)
+        response.headers["cache-control"] = IMMUTABLE if fresh else REVALIDATE
+        return response
+
+    async def encoded_response(
+        self, path: str, full_path: str, stat_result: os.stat_result, scope: Scope
+    ) -> Response:
+        if os.path.splitext(path)[1] not in COMPRESSIBLE or scope["method"] not in ("GET", "HEAD"):
+            return self.file_response(full_path, stat_result, scope)
+
+        accepted = accepted_encodings(Headers(scope=scope))
+        for encoding, suffix in ENCODINGS:
+            if encoding not in accepted:
+                continue
+            encoded_path, encoded_stat = await self.lookup_path(path + suffix)
+            # Siblings older than the file are left over from a previous version
+            if encoded_stat and encoded_stat.st_mtime >= stat_result.st_mtime:
+                media_type = mimetypes.guess_type(path)[0] or "text/plain"
+                response = FileResponse(
+                    encoded_path,
+                    stat_result=encoded_stat,
+                    method=scope["method"],
+                    media_type=media_type,
+                    headers={"content-encoding": encoding, "vary": "Accept-Encoding"},
+                )
+                break
+        else:
+            response = FileResponse(
+                full_path,
+                stat_result=stat_result,
+                method=scope["method"],
+                headers={"vary": "Accept-Encoding"},
+            )
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+def compress_static(directory: str = STATIC_DIR) -> int:
+    """Writes .br and .gz siblings of every compressible static file that's missing or stale.
+    Returns the number of files written."""
+    written = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if os.path.splitext(name)[1] not in COMPRESSIBLE:
+                continue
+            path = os.path.join(root, name)
+            mtime = os.stat(path).st_mtime
+            with open(path, "rb") as f:
+                data = f.read()
+            for suffix, compress in COMPRESSORS.items():
+                target = path + suffix
+                if os.path.exists(target) and os.stat(target).st_mtime >= mtime:
+                    continue
+                compressed = compress(data)
+                if len(compressed) >= len(data):
+                    continue
+                with open(f"{target}.tmp", "wb") as f:
+                    f.write(compressed)
+                os.replace(f"{target}.tmp", target)
+                written += 1
+    return written
+
+
+if __name__ == "__main__":
+    count = compress_static(sys.argv[1] if len(sys.argv) > 1 else STATIC_DIR)
+    print(f"Compressed {count} files")
@@ -1,3 +1,6 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 from fastapi import Depends, HTTPException, Request, status
@@ -8,10 +11,11 @@ from jose import JWTError, jwt
 from passlib.context import CryptContext
 from pydantic import ValidationError
 from sqlalchemy import select
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from snack import config, schema
-from snack.dependencies import get_db
+from snack.cache import principal_cache, user_version
+from snack.database import session_scope
 from snack.models import User
 
 
@@ -58,28 +62,62 @@ oauth2_scheme = OAuth2PasswordBearerCookie(
     },
 )
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Hashes outside the configured cost are flagged by needs_update and rehashed on login
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=config.BCRYPT_ROUNDS,
+    bcrypt__min_rounds=config.BCRYPT_ROUNDS,
+    bcrypt__max_rounds=config.BCRYPT_ROUNDS,
+)
+
+# bcrypt is CPU bound, so it gets its own small pool rather than the shared threadpool
+_hash_executor = ThreadPoolExecutor(
+    max_workers=config.PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash"
+)
+_hash_pending = 0
+
+
+async def _run_hasher(func, *args):
+    """Runs a hashing call in the hash executor, rejecting the request if too many are queued"""
+    global _hash_pending
+    if _hash_pending >= config.PASSWORD_HASH_QUEUE_LIMIT:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy, please try again shortly",
+            headers={"Retry-After": "1"},
+        )
+    _hash_pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_hash_executor, func, *args)
+    finally:
+        _hash_pending -= 1
 
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    """Returns whether the password matches, and a replacement hash if the stored one is outdated"""
+    return await _run_hasher(pwd_context.verify_and_update, plain_password, hashed_password)
 
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    return await _run_hasher(pwd_context.hash, password)
 
 
-def get_user(db: Session, username: str):
-    user = db.execute(select(User).where(User.username == username)).scalar()
+async def get_user(db: AsyncSession, username: str):
+    user = (await db.execute(select(User).where(User.username == username))).scalar()
     return user
 
 
-def authenticate_user(db: Session, username: str, password: str):
-    user = get_user(db=db, username=username)
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = await get_user(db=db, username=username)
     if not user:
         return False
-    if not verify_password(plain_password=password, hashed_password=user.password):
+    valid, new_hash = await verify_password(plain_password=password, hashed_password=user.password)
+    if not valid:
         return False
+    if new_hash:
+        user.password = new_hash
+        await db.commit()
     return user
 
 
@@ -95,11 +133,7 @@ def create_access_token(data: schema.UserInfo, expires_delta: timedelta = None):
     return encoded_jwt
 
 
-def verify_token(
-    security_scopes: SecurityScopes,
-    token: str = Depends(oauth2_scheme),
-    db: Session = Depends(get_db),
-):
+def verify_token(security_scopes: SecurityScopes, token: str = Depends(oauth2_scheme)):
     if security_scopes.scopes:
         authenticate_value = f'Bearer scope="{security_scopes.scope_str}"'
     else:
@@ -110,18 +144,34 @@ def verify_token(
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": authenticate_value},
     )
-    try:
-        payload = jwt.decode(token, str(config.SECRET_KEY), algorithms=[config.ALGORITHM])
-        username: str = payload.get("sub")
-        if not username:
+    # Entries cached before a scope change on any worker are stale
+    version = user_version.value
+    cached = principal_cache.get(token)
+    if cached is not None and cached[0] != version:
+        cached = None
+    if cached is None:
+        try:
+            payload = jwt.decode(token, str(config.SECRET_KEY), algorithms=[config.ALGORITHM])
+            username: str = payload.get("sub")
+            if not username:
+                raise credentials_exception
+            token_scopes = payload.get("scopes", [])
+            token_data = schema.TokenData(scopes=token_scopes, username=username)
+        except (JWTError, ValidationError):
             raise credentials_exception
-        token_scopes = payload.get("scopes", [])
-        token_data = schema.TokenData(scopes=token_scopes, username=username)
-    except (JWTError, ValidationError):
-        raise credentials_exception
-    user = db.execute(select(User).where(User.username == token_data.username)).scalar()
-    if not user:
-        raise credentials_exception
+        # Scoped to the lookup rather than the request, which for a streamed response would
+        # keep the connection checked out until the stream ends
+        with session_scope() as db:
+            user = db.execute(select(User).where(User.username == token_data.username)).scalar()
+            if not user or user.disabled:
+                raise credentials_exception
+            principal = schema.Principal.from_orm(user)
+        # Never cache past the token's own expiry
+        ttl = min(config.PRINCIPAL_CACHE_TTL, payload.get("exp", 0) - time.time())
+        if ttl > 0:
+            principal_cache.set(token, (version, principal, token_data), ttl=ttl)
+    else:
+        _, principal, token_data = cached
     for scope in security_scopes.scopes:
         if scope not in token_data.scopes:
             raise HTTPException(
@@ -129,4 +179,4 @@ def verify_token(
                 detail="Not enough permissions",
                 headers={"WWW-Authenticate": authenticate_value},
             )
-    return user
+    return principal
@@ -1,181 +1,274 @@
+import calendar
+
 from snack.bookclub import schema
 from snack.bookclub.models import Book, Choice, Poll
-from sqlalchemy import func, select, update
-from sqlalchemy.orm import Session
+from snack.cache import book_version
+from sqlalchemy import bindparam, delete, func, insert, literal, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from starlette.concurrency import run_in_threadpool
 
 
 # Polls
-def create_poll(db: Session, poll: schema.PollCreate):
-    """Adds a new poll to the database. Returns the created poll object."""
+async def create_poll(db: AsyncSession, poll: schema.PollCreate):
+    """Adds a new poll to the database along with its choices. Returns the created poll object."""
     obj = Poll(**poll)
     db.add(obj)
-    db.commit()
-    db.refresh(obj)
-    _update_choices(db, obj)
-    db.refresh(obj)
+    await db.flush()
+    await _add_choices(db, obj)
+    await db.commit()
+    await run_in_threadpool(book_version.bump)
     return obj
 
 
-def _update_choices(db: Session, poll: schema.Poll):
-    """Adds existing choices to poll."""
+def _candidates():
+    return (Book.read == False, Book.veto == False, Book.current == False)
+
+
+async def _add_choices(db: AsyncSession, poll: schema.Poll):
+    """Adds every eligible book to the poll with a single INSERT ... SELECT.
+    Primary polls get every unread book, secondary polls get the primary poll's leaders."""
     if poll.primary:
-        for book in get_all_books(db):
-            if not book.read and not book.veto and not book.current:
-                create_choice(db, poll.id, {"book_id": book.id})
+        books = select(literal(poll.id), Book.id).where(*_candidates())
     else:
         primary_id = (
-            db.query(Poll.id).filter(Poll.date == poll.date).filter(Poll.primary == True).scalar()
+            select(Poll.id)
+            .where(Poll.date == poll.date)
+            .where(Poll.primary == True)
+            .scalar_subquery()
+        )
+        max_votes = (
+            select(func.max(Choice.votes)).where(Choice.poll_id == primary_id).scalar_subquery()
         )
-        max_votes = db.execute(
-            select(func.max(Choice.votes)).where(Choice.poll_id == primary_id)
-        ).scalar()
-        results = (
-            db.query(Book)
-            .filter(Choice.book_id == Book.id)
-            .filter(Choice.poll_id == primary_id)
-            .filter(Choice.votes == max_votes)
-            .all()
+        books = (
+            select(literal(poll.id), Book.id)
+            .join(Choice, Choice.book_id == Book.id)
+            .where(Choice.poll_id == primary_id)
+            .where(Choice.votes == max_votes)
+            .where(*_candidates())
         )
-        for book in results:
-            if not book.read and not book.veto and not book.current:
-                create_choice(db, poll.id, {"book_id": book.id})
+    await db.execute(insert(Choice).from_select(["poll_id", "book_id"], books))
 
 
-def complete_poll(db: Session, poll_id: int):
+async def complete_poll(db: AsyncSession, poll_id: int):
     """Finalizes the given poll and either creates the secondary poll
-    or updates the current book to be read."""
-    obj = db.query(Poll).filter(Poll.id == poll_id).first()
-    obj.finished = True
-    db.commit()
-    if obj.primary:
-        _check_veto(db, poll_id)
-        create_poll(db, {"date": obj.date, "primary": False})
+    or updates the current book to be read, all in one transaction."""
+    poll = (
+        await db.execute(
+            update(Poll)
+            .where(Poll.id == poll_id)
+            .values(finished=True)
+            .returning(Poll.date, Poll.primary)
+        )
+    ).one()
+    if poll.primary:
+        await _check_veto(db, poll_id)
+        secondary = Poll(date=poll.date, primary=False)
+        db.add(secondary)
+        await db.flush()
+        await _add_choices(db, secondary)
     else:
-        _update_current(db, poll_id)
+        await _update_current(db, poll_id)
+    await db.commit()
+    await run_in_threadpool(book_version.bump)
 
 
-def _update_current(db: Session, poll_id: int):
+async def _update_current(db: AsyncSession, poll_id: int):
     """Update current book with results from poll."""
     # Set current book as read
-    current = get_current_book(db)
-    if current is not None:
-        current.current = False
-        current.read = True
-        db.commit()
-
-    # Calculate result
-    max_votes = db.execute(select(func.max(Choice.votes)).where(Choice.poll_id == poll_id)).scalar()
-    result = (
-        db.query(Book)
-        .filter(Choice.book_id == Book.id)
-        .filter(Choice.poll_id == poll_id)
-        .filter(Choice.votes == max_votes)
-        .one()
+    await db.execute(update(Book).where(Book.current == True).values(current=False, read=True))
+    # Ties go to the choice added first, so there's only ever one current book
+    winner = (
+        select(Choice.book_id)
+        .where(Choice.poll_id == poll_id)
+        .order_by(Choice.votes.desc(), Choice.id)
+        .limit(1)
+        .scalar_subquery()
     )
-    # Set new current book
-    result.current = True
-    db.commit()
+    await db.execute(update(Book).where(Book.id == winner).values(current=True))
 
 
-def _check_veto(db: Session, poll_id: int):
+async def _check_veto(db: AsyncSession, poll_id: int):
     """Sets veto on books with 1 or less votes in primary poll."""
-    objs = (
-        db.query(Book)
-        .filter(Choice.book_id == Book.id)
-        .filter(Choice.poll_id == poll_id)
-        .filter(Choice.votes <= 1)
-        .all()
+    vetoed = select(Choice.book_id).where(Choice.poll_id == poll_id).where(Choice.votes <= 1)
+    await db.execute(update(Book).where(Book.id.in_(vetoed)).values(veto=True))
+
+
+async def get_poll(db: AsyncSession, poll_id: int):
+    """Get a poll with its choices and their books loaded."""
+    stmt = (
+        select(Poll)
+        .options(selectinload(Poll.choices).selectinload(Choice.book))
+        .where(Poll.id == poll_id)
     )
-    for obj in objs:
-        obj.veto = True
-        db.commit()
+    return (await db.execute(stmt)).scalar()
 
 
-def get_poll(db: Session, poll_id: int):
-    return db.query(Poll).filter(Poll.id == poll_id).first()
+async def get_all_polls(db: AsyncSession):
+    return (await db.execute(select(Poll))).scalars().all()
 
 
-def get_all_polls(db: Session):
-    return db.query(Poll).all()
+def format_poll_date(date: int) -> str:
+    """Formats a YYYYMM poll date as e.g. September 2021"""
+    year, month = divmod(date, 100)
+    return f"{calendar.month_name[month]} {year}"
 
 
-def get_poll_info(db: Session, poll_id: int):
-    stmt = db.query(Choice).filter(Choice.poll_id == poll_id).join(Choice.book_id)
-    obj = db.execute(stmt)
-    return obj
+async def get_open_polls(db: AsyncSession) -> list[dict]:
+    """Returns the ID, formatted date and type of each unfinished poll, newest first."""
+    rows = await db.execute(
+        select(Poll.id, Poll.date, Poll.primary)
+        .where(Poll.finished == False)
+        .order_by(Poll.date.desc(), Poll.primary.desc())
+    )
+    return [
+        {"id": poll_id, "date": format_poll_date(date), "primary": primary}
+        for poll_id, date, primary in rows
+    ]
+
+
+async def get_poll_info(db: AsyncSession, poll_id: int):
+    stmt = select(Choice).options(selectinload(Choice.book)).where(Choice.poll_id == poll_id)
+    return (await db.execute(stmt)).scalars().all()
 
 
-def check_poll_exists(db: Session, date: int):
-    obj = db.query(Poll).filter(Poll.date == date).filter(Poll.primary == True).scalar()
+async def check_poll_exists(db: AsyncSession, date: int):
+    obj = (
+        await db.execute(select(Poll.id).where(Poll.date == date).where(Poll.primary == True))
+    ).scalar()
     return obj is not None
 
 
-def edit_poll(db: Session, poll: schema.Poll):
-    obj = db.query(Poll).filter(Poll.id == poll.id).first()
+async def edit_poll(db: AsyncSession, poll: schema.Poll):
+    obj = (await db.execute(select(Poll).where(Poll.id == poll.id))).scalar()
     obj.date = poll.date
-    db.commit()
+    await db.commit()
+    await run_in_threadpool(book_version.bump)
     return obj
 
 
-def delete_poll(db: Session, poll_id: int):
-    db.query(Poll).filter(Poll.id == poll_id).delete()
-    db.commit()
+async def delete_poll(db: AsyncSession, poll_id: int):
+    await db.execute(delete(Poll).where(Poll.id == poll_id))
+    await db.commit()
+    await run_in_threadpool(book_version.bump)
 
 
 # Choices
-def create_choice(db: Session, poll_id: int, choice: schema.ChoiceCreate):
-    obj = Choice(**choice, poll_id=poll_id)
-    db.add(obj)
-    db.commit()
-    return obj
+async def submit_ballot(db: AsyncSession, poll_id: int, user: str, votes: list[tuple[int, int]]):
+    """Records a user's votes as (choice_id, votes) pairs in a single transaction.
+    Returns the poll's tally including the ballot, as from get_tally, or None without counting
+    anything if the user has already voted in the poll."""
+    # The poll row lock serializes ballots, and the guard is rechecked once a concurrent one commits
+    voted = await db.execute(
+        update(Poll)
+        .where(Poll.id == poll_id)
+        .where(or_(Poll.users_voted == None, ~Poll.users_voted.any(user)))
+        .values(users_voted=func.array_append(Poll.users_voted, user, type_=Poll.users_voted.type))
+        .returning(func.cardinality(Poll.users_voted))
+    )
+    ballots = voted.scalar()
+    if ballots is None:
+        await db.rollback()
+        return None
+    if votes:
+        choices = Choice.__table__
+        await db.execute(
+            update(choices)
+            .where(choices.c.id == bindparam("choice_id"))
+            .where(choices.c.poll_id == poll_id)
+            .values(votes=choices.c.votes + bindparam("n")),
+            [{"choice_id": choice_id, "n": n} for choice_id, n in votes],
+        )
+    # Still under the row lock, so these are exactly the counts left by this ballot
+    counts = await db.execute(select(Choice.id, Choice.votes).where(Choice.poll_id == poll_id))
+    tally = {"ballots": ballots, "votes": dict(counts.all())}
+    await db.commit()
+    return tally
+
+
+async def get_tally(db: AsyncSession, poll_id: int) -> dict:
+    """Returns {"ballots": ballots counted, "votes": {choice_id: votes}} for the poll, or None if
+    it doesn't exist. The ballot count orders tallies read at different times."""
+    rows = (
+        await db.execute(
+            select(func.coalesce(func.cardinality(Poll.users_voted), 0), Choice.id, Choice.votes)
+            .outerjoin(Choice, Choice.poll_id == Poll.id)
+            .where(Poll.id == poll_id)
+        )
+    ).all()
+    if not rows:
+        return None
+    return {
+        "ballots": rows[0][0],
+        "votes": {choice_id: votes for _, choice_id, votes in rows if choice_id is not None},
+    }
 
 
-def update_vote(db: Session, choice_id: int, votes: int = 1):
-    obj = db.query(Choice).filter(Choice.id == choice_id).first()
-    obj.votes += votes
-    db.commit()
-    return obj
+async def get_voters(db: AsyncSession, poll_id: int) -> list[str]:
+    return (await db.execute(select(Poll.users_voted).where(Poll.id == poll_id))).scalar()
 
 
-def update_voters(db: Session, poll_id: int, user: str):
-    obj = db.query(Poll).filter(Poll.id == poll_id).first()
-    obj.users_voted.append(user)
-    db.execute(update(Poll).where(Poll.id == poll_id).values(users_voted=obj.users_voted))
-    db.commit()
+# Books
+async def create_book(db: AsyncSession, book: schema.BookCreate):
+    obj = Book(**book.dict())
+    db.add(obj)
+    await db.commit()
+    await run_in_threadpool(book_version.bump)
     return obj
 
 
-def get_voters(db: Session, poll_id: int) -> list[str]:
-    obj = db.query(Poll).filter(Poll.id == poll_id).first()
-    return obj.users_voted
+async def create_books(db: AsyncSession, books: list[dict]):
+    """Adds several books in a single transaction."""
+    objs = [Book(**book) for book in books]
+    db.add_all(objs)
+    await db.commit()
+    await run_in_threadpool(book_version.bump)
+    return objs
 
 
-# Books
-def create_book(db: Session, book: schema.BookCreate):
-    obj = Book(**book.dict())
-    db.add(obj)
-    db.commit()
-    return obj
+async def get_existing_source_urls(db: AsyncSession, source_urls: list[str]) -> set[str]:
+    """Returns which of the given canonical URLs are already in the book list."""
+    rows = await db.execute(select(Book.source_url).where(Book.source_url.in_(source_urls)))
+    return set(rows.scalars())
+
+
+async def get_existing_titles(db: AsyncSession, titles: list[str]) -> set[str]:
+    """Returns which of the given titles are already in the book list."""
+    rows = await db.execute(select(Book.title).where(Book.title.in_(titles)))
+    return set(rows.scalars())
 
 
-def get_book(db: Session, book_id: int = None, title: str = None):
-    """Get a book object from the database by ID or title.
-    ID will take priority if both are given."""
+async def get_book(
+    db: AsyncSession, book_id: int = None, title: str = None, source_url: str = None
+):
+    """Get a book object from the database by ID, title or canonical Goodreads URL.
+    ID will take priority, then title, if more than one is given."""
     if book_id is not None:
-        return db.query(Book).filter(Book.id == book_id).first()
+        stmt = select(Book).where(Book.id == book_id)
     elif title is not None:
-        return db.query(Book).filter(Book.title == title).first()
-    raise ValueError("ID or title must be given")
+        stmt = select(Book).where(Book.title == title)
+    elif source_url is not None:
+        stmt = select(Book).where(Book.source_url == source_url)
+    else:
+        raise ValueError("ID, title or URL must be given")
+    return (await db.execute(stmt.limit(1))).scalar()
+
+
+async def get_all_books(db: AsyncSession):
+    return (await db.execute(select(Book))).scalars().all()
 
 
-def get_all_books(db: Session):
-    return db.query(Book).all()
+async def get_candidate_books(db: AsyncSession):
+    """Returns the ID, title and author of each book that can still be voted on, by title."""
+    stmt = select(Book.id, Book.title, Book.author).where(*_candidates()).order_by(Book.title)
+    return (await db.execute(stmt)).all()
 
 
-def get_current_book(db: Session):
-    return db.query(Book).filter(Book.current == True).one_or_none()
+async def get_current_book(db: AsyncSession):
+    return (await db.execute(select(Book).where(Book.current == True))).scalar_one_or_none()
 
 
-def delete_book(db: Session, book_id: int):
-    db.query(Book).filter(Book.id == book_id).delete()
-    db.commit()
+async def delete_book(db: AsyncSession, book_id: int):
+    await db.execute(delete(Book).where(Book.id == book_id))
+    await db.commit()
+    await run_in_threadpool(book_version.bump)
@@ -0,0 +1,57 @@
+import asyncio
+from collections import defaultdict
+from contextlib import contextmanager
+
+from snack import config
+
+
+class Subscriber:
+    def __init__(self, maxsize: int):
+        self.queue = asyncio.Queue(maxsize)
+
+    def put(self, tally: dict):
+        try:
+            self.queue.put_nowait(tally)
+        except asyncio.QueueFull:
+            # Counts are absolute, so a slow client only needs the newest of those it missed
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(tally)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class PollBroadcaster:
+    """
+    In-process fan-out of vote tallies to everyone watching a poll\n
+    Each ballot is published once and copied to every subscriber's bounded queue, so watchers
+    never query the database for updates. Only reaches viewers connected to the same process.
+    """
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self._subscribers = defaultdict(set)
+
+    @contextmanager
+    def subscribe(self, poll_id: int):
+        subscriber = Subscriber(self.queue_size)
+        self._subscribers[poll_id].add(subscriber)
+        try:
+            yield subscriber
+        finally:
+            subscribers = self._subscribers[poll_id]
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[poll_id]
+
+    def publish(self, poll_id: int, tally: dict):
+        """Sends the poll's tally after a ballot to its subscribers, never blocking the voter"""
+        for subscriber in self._subscribers.get(poll_id, ()):
+            subscriber.put(tally)
+
+    def watchers(self) -> dict:
+        return {poll_id: len(subscribers) for poll_id, subscribers in self._subscribers.items()}
+
+
+broadcaster = PollBroadcaster(config.LIVE_QUEUE_SIZE)
@@ -1,5 +1,5 @@
 from snack.database import Base
-from sqlalchemy import ARRAY, Boolean, Column, ForeignKey, Integer, String
+from sqlalchemy import ARRAY, JSON, Boolean, Column, ForeignKey, Index, Integer, String, and_
 from sqlalchemy.orm import relationship
 
 
@@ -13,17 +13,25 @@ class Poll(Base):
 
     choices = relationship("Choice", back_populates="poll")
 
+    # Only the few open polls are indexed, so the dashboard doesn't slow as history grows
+    __table_args__ = (
+        Index("ix_polls_open", "date", "primary", postgresql_where=(finished == False)),
+    )
+
 
 class Choice(Base):
     __tablename__ = "choices"
     id = Column(Integer, primary_key=True)
     poll_id = Column(Integer, ForeignKey("polls.id", ondelete="CASCADE"))
-    book_id = Column(Integer, ForeignKey("books.id", ondelete="CASCADE"))
+    book_id = Column(Integer, ForeignKey("books.id", ondelete="CASCADE"), index=True)
     votes = Column(Integer, default=0)
 
     book = relationship("Book")
     poll = relationship("Poll", back_populates="choices")
 
+    # Tallies and leaders of a poll are read straight off this index
+    __table_args__ = (Index("ix_choices_poll_id_votes", "poll_id", "votes"),)
+
 
 class Book(Base):
     __tablename__ = "books"
@@ -33,6 +41,17 @@ class Book(Base):
     page_count = Column(Integer)
     description = Column(String)
     image = Column(String)
+    image_variants = Column(JSON)  # {ext: {width: path}} of resized covers
+    source_url = Column(String, index=True)  # Canonical Goodreads URL
     current = Column(Boolean, default=False)
     read = Column(Boolean, default=False)
     veto = Column(Boolean, default=False)
+
+    # Indexes only the books that can still be put to a vote
+    __table_args__ = (
+        Index(
+            "ix_books_candidates",
+            "title",
+            postgresql_where=and_(read == False, veto == False, current == False),
+        ),
+    )
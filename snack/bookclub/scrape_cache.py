@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import time
+from urllib.parse import urlsplit
+
+import aiofiles
+from snack import config
+
+_BOOK_ID = re.compile(r"^/book/show/(\d+)")
+
+
+class ScrapeCacheMiss(LookupError):
+    """Raised in offline mode when a URL has never been scraped."""
+
+
+def canonical_url(url: str) -> str:
+    """Reduces a Goodreads book URL to https://www.goodreads.com/book/show/<id>,
+    dropping the title slug, query string and fragment."""
+    parts = urlsplit(url.strip())
+    match = _BOOK_ID.match(parts.path)
+    if match:
+        return f"https://www.goodreads.com/book/show/{match.group(1)}"
+    return f"{parts.scheme}://{parts.netloc.lower()}{parts.path.rstrip('/')}"
+
+
+def _entry_path(url: str, suffix: str) -> str:
+    key = hashlib.sha256(url.encode()).hexdigest()[:32]
+    return os.path.join(config.SCRAPE_CACHE_DIR, f"{key}{suffix}")
+
+
+async def load(url: str) -> dict | None:
+    """Returns the parsed fields cached for a canonical URL, or None if missing or stale.
+    Entries never go stale in offline mode."""
+    try:
+        async with aiofiles.open(_entry_path(url, ".json")) as file:
+            entry = json.loads(await file.read())
+        fetched_at, data = entry["fetched_at"], entry["data"]
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError, TypeError):
+        # An unreadable entry is scraped again rather than failing the request
+        return None
+    if not config.SCRAPE_OFFLINE and time.time() - fetched_at > config.SCRAPE_CACHE_TTL:
+        return None
+    return data
+
+
+async def load_page(url: str) -> bytes | None:
+    """Returns the raw page stored for a canonical URL, for replaying the parser."""
+    try:
+        async with aiofiles.open(_entry_path(url, ".html"), "rb") as file:
+            return await file.read()
+    except FileNotFoundError:
+        return None
+
+
+async def _write(path: str, content: bytes):
+    """Replaces the file in one step, so readers never see it partly written"""
+    # Unique per write, as the same URL may be scraped by two requests at once
+    tmp_path = f"{path}.{os.urandom(4).hex()}.tmp"
+    async with aiofiles.open(tmp_path, "wb") as file:
+        await file.write(content)
+    os.replace(tmp_path, path)
+
+
+async def store(url: str, page: bytes, data: dict):
+    os.makedirs(config.SCRAPE_CACHE_DIR, exist_ok=True)
+    await _write(_entry_path(url, ".html"), page)
+    # Written last, so an entry is only visible once its page is on disk
+    entry = {"url": url, "fetched_at": time.time(), "data": data}
+    await _write(_entry_path(url, ".json"), json.dumps(entry).encode())
@@ -1,24 +1,87 @@
 from __future__ import annotations
 
+import asyncio
 import os
 import re
 
-import requests
+import aiofiles
+import httpx
 from bs4 import BeautifulSoup
 from slugify import slugify
-from snack.bookclub.models import Book
-from sqlalchemy.orm import Session
+from snack import config
+from snack.bookclub import scrape_cache
+from snack.images import cover_variants
+from starlette.concurrency import run_in_threadpool
 
 headers = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:84.0) Gecko/20100101 Firefox/84.0"
 }
 
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
-async def get_book_data(db: Session, url: str):
-    book_page = requests.get(url, headers=headers)
-    book_page.raise_for_status()
+_client: httpx.AsyncClient = None
 
-    book_soup = BeautifulSoup(book_page.content, "html.parser")
+
+def get_client() -> httpx.AsyncClient:
+    """Returns the shared client, so connections to Goodreads are pooled across requests."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            headers=headers,
+            timeout=httpx.Timeout(config.SCRAPE_TIMEOUT),
+            limits=httpx.Limits(max_connections=config.SCRAPE_MAX_CONNECTIONS),
+        )
+    return _client
+
+
+async def close_client():
+    if _client is not None:
+        await _client.aclose()
+
+
+def _should_retry(exc: httpx.HTTPError) -> bool:
+    if isinstance(exc, httpx.TransportError):
+        return True
+    return isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code in RETRY_STATUSES
+
+
+async def _with_retries(request):
+    """Awaits request(), retrying transient failures with exponential backoff."""
+    attempt = 0
+    while True:
+        try:
+            return await request()
+        except httpx.HTTPError as exc:
+            if attempt >= config.SCRAPE_RETRIES or not _should_retry(exc):
+                raise
+        await asyncio.sleep(config.SCRAPE_BACKOFF * 2 ** attempt)
+        attempt += 1
+
+
+async def fetch_page(client: httpx.AsyncClient, url: str) -> bytes:
+    async def request():
+        response = await client.get(url)
+        response.raise_for_status()
+        return response.content
+
+    return await _with_retries(request)
+
+
+async def download_file(client: httpx.AsyncClient, url: str, path: str):
+    """Streams the response body to disk in chunks."""
+
+    async def request():
+        async with client.stream("GET", url) as response:
+            response.raise_for_status()
+            async with aiofiles.open(path, "wb") as file:
+                async for chunk in response.aiter_bytes():
+                    await file.write(chunk)
+
+    await _with_retries(request)
+
+
+def parse_book_page(content: bytes) -> dict[str, str | int]:
+    book_soup = BeautifulSoup(content, "html.parser")
 
     description_container = book_soup.find("div", id="descriptionContainer")
     description: str = description_container.find("span", id=re.compile("^freeText[0-9]")).text
@@ -31,18 +94,54 @@ async def get_book_data(db: Session, url: str):
     page_count = int(book_soup.find("span", itemprop="numberOfPages").text.replace(" pages", ""))
     image_url: str = book_soup.find("img", id="coverImage")["src"]
 
-    os.makedirs("static/covers/", exist_ok=True)
-    image_path = f"static/covers/{slugify(title, max_length=30, word_boundary=True)}.jpg"
-    with requests.get(image_url, stream=True, headers=headers) as response:
-        with open(image_path, "wb") as file:
-            file.write(response.content)
-
-    book_info: dict[str, str | int] = {
+    return {
         "title": title,
         "author": author,
         "page_count": page_count,
-        "image": image_path.removeprefix("static"),
         "description": description,
+        "image_url": image_url,
     }
 
+
+async def get_book_data(url: str, client: httpx.AsyncClient = None):
+    """Returns book fields for a Goodreads URL, from the scrape cache where possible.
+    In offline mode only cached pages are used and ScrapeCacheMiss is raised otherwise."""
+    url = scrape_cache.canonical_url(url)
+    client = client or get_client()
+
+    book_info = await scrape_cache.load(url)
+    if book_info is None:
+        book_page = await scrape_cache.load_page(url) if config.SCRAPE_OFFLINE else None
+        if book_page is None:
+            if config.SCRAPE_OFFLINE:
+                raise scrape_cache.ScrapeCacheMiss(url)
+            book_page = await fetch_page(client, url)
+        # Parsing is CPU bound, keep it off the event loop
+        book_info = await run_in_threadpool(parse_book_page, book_page)
+        await scrape_cache.store(url, book_page, book_info)
+    book_info = dict(book_info)
+    image_url = book_info.pop("image_url")
+
+    os.makedirs("static/covers/", exist_ok=True)
+    image_slug = slugify(book_info["title"], max_length=30, word_boundary=True)
+    image_path = f"static/covers/{image_slug}.jpg"
+    if not os.path.exists(image_path) and not config.SCRAPE_OFFLINE:
+        await download_file(client, image_url, image_path)
+
+    book_info["image"] = image_path.removeprefix("static")
+    if os.path.exists(image_path):
+        book_info["image_variants"] = await run_in_threadpool(cover_variants, image_path)
+    book_info["source_url"] = url
     return book_info
+
+
+async def get_many_book_data(urls: list[str], concurrency: int = None) -> list:
+    """Scrapes several URLs concurrently, at most `concurrency` at a time.
+    Returns book fields or the raised exception for each URL, in order."""
+    semaphore = asyncio.Semaphore(concurrency or config.SCRAPE_CONCURRENCY)
+
+    async def scrape(url):
+        async with semaphore:
+            return await get_book_data(url)
+
+    return await asyncio.gather(*(scrape(url) for url in urls), return_exceptions=True)
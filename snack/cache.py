@@ -0,0 +1,176 @@
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import Integer, cast, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from starlette.concurrency import run_in_threadpool
+
+from snack import config
+from snack.database import session_scope
+from snack.models import Version
+
+
+class LRUCache:
+    """
+    Thread-safe bounded mapping that evicts the least recently used entry when full\n
+    Entries may be given a TTL in seconds, after which they're treated as missing
+    """
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def pop_where(self, predicate):
+        """Removes every entry whose value matches the predicate"""
+        with self._lock:
+            for key in [key for key, (value, _) in self._data.items() if predicate(value)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def _epoch_now():
+    return cast(func.extract("epoch", func.now()), Integer)
+
+
+class ContentVersion:
+    """
+    Counter bumped whenever the content it covers changes, used to validate cached pages\n
+    Stored in the database so a write handled by one worker is seen by all of them. Reads are
+    reused for VERSION_CHECK_INTERVAL seconds, which bounds how long another worker's bump goes
+    unseen, while a worker's own bumps are seen straight away
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._state = (0, 0)  # (value, last_modified)
+        self._checked = None
+
+    def _store(self, state: tuple[int, int]):
+        with self._lock:
+            self._state = state
+            self._checked = time.monotonic()
+
+    def _due(self) -> bool:
+        checked = self._checked
+        return checked is None or time.monotonic() - checked >= config.VERSION_CHECK_INTERVAL
+
+    def read(self) -> tuple[int, int]:
+        """Returns the shared (value, last_modified) pair"""
+        if self._due():
+            with session_scope() as db:
+                row = db.execute(
+                    select(Version.value, Version.last_modified).where(Version.name == self.name)
+                ).one_or_none()
+            self._store(tuple(row) if row is not None else (0, 0))
+        return self._state
+
+    @property
+    def value(self) -> int:
+        return self.read()[0]
+
+    @property
+    def last_modified(self) -> int:
+        return self.read()[1]
+
+    async def current(self) -> int:
+        """The value for code on the event loop, rechecked in the threadpool when due"""
+        if self._due():
+            await run_in_threadpool(self.read)
+        return self._state[0]
+
+    def bump(self):
+        """Increments the shared counter in its own transaction. Blocks, so async callers
+        should run it in the threadpool"""
+        now = _epoch_now()
+        with session_scope() as db:
+            row = db.execute(
+                pg_insert(Version)
+                .values(name=self.name, value=1, last_modified=now)
+                .on_conflict_do_update(
+                    index_elements=[Version.name],
+                    set_={"value": Version.value + 1, "last_modified": now},
+                )
+                .returning(Version.value, Version.last_modified)
+            ).one()
+            db.commit()
+        self._store(tuple(row))
+
+
+content_version = ContentVersion("content")
+# Bumped by writes to bookclub books and polls, which don't affect validators of blog pages
+book_version = ContentVersion("books")
+# Bumped when a user's scopes change, so every worker drops its cached principals
+user_version = ContentVersion("users")
+
+
+def init_versions():
+    """Creates any missing version rows, starting them at the current time so Last-Modified
+    is the same on every worker"""
+    now = _epoch_now()
+    rows = [
+        {"name": version.name, "value": 0, "last_modified": now}
+        for version in (content_version, book_version, user_version)
+    ]
+    with session_scope() as db:
+        db.execute(
+            pg_insert(Version).values(rows).on_conflict_do_nothing(index_elements=[Version.name])
+        )
+        db.commit()
+
+
+# Rendered article content and post metadata keyed by slug
+post_cache = LRUCache(maxsize=config.POST_CACHE_SIZE)
+
+# Verified access tokens mapped to their user principal and granted scopes
+principal_cache = LRUCache(maxsize=config.PRINCIPAL_CACHE_SIZE)
+
+# Rendered template fragments keyed by content versions and the key given in the template
+fragment_cache = LRUCache(maxsize=config.FRAGMENT_CACHE_SIZE)
@@ -0,0 +1,137 @@
+import zlib
+
+import brotli
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from snack.assets import accepted_encodings
+
+# Only text formats are compressed, images and precompressed static files are left alone
+COMPRESSIBLE_TYPES = {
+    "text/html",
+    "text/css",
+    "text/plain",
+    "text/javascript",
+    "text/xml",
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "image/svg+xml",
+}
+
+
+class _Gzip:
+    def __init__(self, level: int):
+        # wbits=31 writes a gzip header and trailer around the deflate stream
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class _Brotli:
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class CompressionMiddleware:
+    """
+    Compresses text responses with brotli, or gzip for clients that don't accept it\n
+    Responses that are too small, already encoded, empty (204/304) or of a type outside
+    COMPRESSIBLE_TYPES are sent untouched, as are event streams, so they're never buffered
+    """
+
+    def __init__(
+        self, app: ASGIApp, minimum_size: int = 500, gzip_level: int = 6, brotli_quality: int = 4
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.encoders = {
+            "br": lambda: _Brotli(brotli_quality),
+            "gzip": lambda: _Gzip(gzip_level),
+        }
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        accepted = accepted_encodings(Headers(scope=scope))
+        encoding = next((name for name in self.encoders if name in accepted), None)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        responder = _CompressionResponder(
+            send, encoding, self.encoders[encoding], self.minimum_size
+        )
+        await self.app(scope, receive, responder.send)
+
+
+class _CompressionResponder:
+    def __init__(self, send: Send, encoding: str, encoder, minimum_size: int):
+        self._send = send
+        self.encoding = encoding
+        self.encoder = encoder
+        self.minimum_size = minimum_size
+        self.start_message = None
+        self.compressor = None
+        self.passthrough = False
+
+    def _compressible(self, message: Message) -> bool:
+        headers = Headers(raw=message["headers"])
+        if message["status"] in (204, 304) or "content-encoding" in headers:
+            return False
+        media_type = headers.get("content-type", "").partition(";")[0].strip().lower()
+        return media_type in COMPRESSIBLE_TYPES
+
+    async def send(self, message: Message):
+        if message["type"] == "http.response.start":
+            if not self._compressible(message):
+                self.passthrough = True
+                await self._send(message)
+                return
+            # Held back until the first part of the body shows whether it's worth compressing
+            self.start_message = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self._send(message)
+            return
+
+        more_body = message.get("more_body", False)
+        if self.compressor is None:
+            headers = MutableHeaders(raw=self.start_message["headers"])
+            # A body that arrives in several parts is assumed to be large
+            if not more_body and len(message.get("body", b"")) < self.minimum_size:
+                self.passthrough = True
+                await self._send(self.start_message)
+                await self._send(message)
+                return
+            self.compressor = self.encoder()
+            headers["content-encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            # The compressed body is a different representation, so a strong ETag is weakened
+            etag = headers.get("etag")
+            if etag and not etag.startswith("W/"):
+                headers["etag"] = f"W/{etag}"
+            body = self.compressor.compress(message.get("body", b""))
+            if more_body:
+                del headers["content-length"]
+            else:
+                body += self.compressor.finish()
+                headers["content-length"] = str(len(body))
+            await self._send(self.start_message)
+            await self._send({"type": "http.response.body", "body": body, "more_body": more_body})
+            return
+
+        body = self.compressor.compress(message.get("body", b""))
+        if not more_body:
+            body += self.compressor.finish()
+        await self._send({"type": "http.response.body", "body": body, "more_body": more_body})
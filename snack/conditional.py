@@ -0,0 +1,69 @@
+import hashlib
+import os
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import Request
+from fastapi.responses import Response
+
+from snack import config
+from snack.cache import content_version
+from snack.templating import TEMPLATE_DIR
+
+
+def _template_state() -> tuple[str, int]:
+    """Digest and newest modification time of the templates, which are the same on every worker
+    of a deploy, so template changes aren't masked by a stale validator"""
+    digest = hashlib.sha1()
+    newest = 0
+    for root, _, files in os.walk(TEMPLATE_DIR):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                digest.update(f.read())
+            newest = max(newest, int(os.stat(path).st_mtime))
+    return digest.hexdigest(), newest
+
+
+_TEMPLATE_DIGEST, _TEMPLATE_MTIME = _template_state()
+
+
+def _validators(request: Request) -> dict:
+    # Read once so the ETag and Last-Modified describe the same version
+    version, last_modified = content_version.read()
+    url = f"{request.url.path}?{request.url.query}"
+    seed = f"{config.VERSION}:{_TEMPLATE_DIGEST}:{version}:{url}"
+    return {
+        "ETag": f'"{hashlib.sha1(seed.encode()).hexdigest()}"',
+        "Last-Modified": formatdate(max(last_modified, _TEMPLATE_MTIME), usegmt=True),
+        "Cache-Control": "no-cache",
+    }
+
+
+def not_modified(request: Request) -> Response:
+    """
+    Returns a 304 response if the client's cached copy of the page is still current, else None\n
+    Should be called before any database or template work
+    """
+    # Validators are captured before rendering so a concurrent edit can't be masked
+    headers = request.state.validators = _validators(request)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if "*" in tags or headers["ETag"] in tags:
+            return Response(status_code=304, headers=headers)
+        return None
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return None
+        if parsedate_to_datetime(headers["Last-Modified"]).timestamp() <= since:
+            return Response(status_code=304, headers=headers)
+    return None
+
+
+def set_validators(request: Request, response: Response) -> Response:
+    """Adds ETag and Last-Modified headers for the current content version to the response"""
+    response.headers.update(getattr(request.state, "validators", None) or _validators(request))
+    return response
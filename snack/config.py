@@ -6,10 +6,14 @@ config = Config('.env')
 PROJECT_NAME = 'The Midnight Snack'
 VERSION = '1.0.0'
 API_PREFIX = ''
+DEBUG = config('DEBUG', cast=bool, default=False)
+TEMPLATE_CACHE_DIR = config('TEMPLATE_CACHE_DIR', cast=str, default='.cache/templates')
 
 SECRET_KEY = config('SECRET_KEY', cast=Secret, default='CHANGE')
 ALGORITHM = config('ALGORITHM', cast=str)
 ACCESS_TOKEN_EXPIRE_MINUTES = config('ACCESS_TOKEN_EXPIRE_MINUTES', cast=int, default=15)
+PRINCIPAL_CACHE_TTL = config('PRINCIPAL_CACHE_TTL', cast=int, default=60)
+PRINCIPAL_CACHE_SIZE = config('PRINCIPAL_CACHE_SIZE', cast=int, default=1024)
 
 POSTGRES_USER = config('POSTGRES_USER', cast=str)
 POSTGRES_PASSWORD = config('POSTGRES_PASSWORD', cast=Secret)
@@ -17,4 +21,37 @@ POSTGRES_SERVER = config('POSTGRES_SERVER', cast=str, default='db')
 POSTGRES_PORT = config('POSTGRES_PORT', cast=str, default='5432')
 POSTGRES_DB = config('POSTGRES_DB', cast=str)
 
-DATABASE_URL = f'postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB}'
\ No newline at end of file
+DATABASE_URL = f'postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB}'
+ASYNC_DATABASE_URL = f'postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB}'
+POST_CACHE_SIZE = config('POST_CACHE_SIZE', cast=int, default=128)
+POSTS_PER_PAGE = config('POSTS_PER_PAGE', cast=int, default=20)
+SEARCH_CONFIG = config('SEARCH_CONFIG', cast=str, default='english')
+VERSION_CHECK_INTERVAL = config('VERSION_CHECK_INTERVAL', cast=float, default=1)
+FRAGMENT_CACHE_SIZE = config('FRAGMENT_CACHE_SIZE', cast=int, default=256)
+FRAGMENT_CACHE_TTL = config('FRAGMENT_CACHE_TTL', cast=int, default=3600)
+
+DB_POOL_SIZE = config('DB_POOL_SIZE', cast=int, default=5)
+DB_MAX_OVERFLOW = config('DB_MAX_OVERFLOW', cast=int, default=10)
+DB_POOL_TIMEOUT = config('DB_POOL_TIMEOUT', cast=float, default=30)
+DB_POOL_PRE_PING = config('DB_POOL_PRE_PING', cast=bool, default=True)
+DB_POOL_RECYCLE = config('DB_POOL_RECYCLE', cast=int, default=1800)
+
+BCRYPT_ROUNDS = config('BCRYPT_ROUNDS', cast=int, default=12)
+PASSWORD_HASH_WORKERS = config('PASSWORD_HASH_WORKERS', cast=int, default=2)
+PASSWORD_HASH_QUEUE_LIMIT = config('PASSWORD_HASH_QUEUE_LIMIT', cast=int, default=32)
+
+SCRAPE_TIMEOUT = config('SCRAPE_TIMEOUT', cast=float, default=10)
+SCRAPE_RETRIES = config('SCRAPE_RETRIES', cast=int, default=2)
+SCRAPE_BACKOFF = config('SCRAPE_BACKOFF', cast=float, default=0.5)
+SCRAPE_MAX_CONNECTIONS = config('SCRAPE_MAX_CONNECTIONS', cast=int, default=10)
+SCRAPE_CACHE_DIR = config('SCRAPE_CACHE_DIR', cast=str, default='.cache/goodreads')
+SCRAPE_CACHE_TTL = config('SCRAPE_CACHE_TTL', cast=int, default=7 * 24 * 60 * 60)
+SCRAPE_OFFLINE = config('SCRAPE_OFFLINE', cast=bool, default=False)
+SCRAPE_CONCURRENCY = config('SCRAPE_CONCURRENCY', cast=int, default=4)
+
+COMPRESSION_MIN_SIZE = config('COMPRESSION_MIN_SIZE', cast=int, default=500)
+GZIP_LEVEL = config('GZIP_LEVEL', cast=int, default=6)
+BROTLI_QUALITY = config('BROTLI_QUALITY', cast=int, default=4)
+
+LIVE_QUEUE_SIZE = config('LIVE_QUEUE_SIZE', cast=int, default=32)
+LIVE_HEARTBEAT = config('LIVE_HEARTBEAT', cast=float, default=15)
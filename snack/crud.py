@@ -1,38 +1,57 @@
+import base64
+import hashlib
+import re
 import shutil
+from datetime import datetime
 from pathlib import Path
 
-from sqlalchemy import delete, insert, select, update
+from bs4 import BeautifulSoup
+from sqlalchemy import delete, func, literal, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload, selectinload
+from starlette.concurrency import run_in_threadpool
 
-from snack import schema
+from snack import config, images, schema
+from snack.cache import content_version, post_cache, principal_cache, user_version
+from snack.database import session_scope
 from snack.models import Post, Tag, User, tag_assoc_table
 
 
 # Post
-def tag_handler(db: Session, tags: list[Tag], post: Post):
-    post_id = db.execute(select(Post.id).where(Post.title == post.title)).scalar()
-    for tag in tags:
-        tag_obj = db.execute(select(Tag).where(Tag.name == tag.name)).scalar()
-        if not tag_obj:
-            tag.posts.append(post)
-            db.add(tag)
-            db.commit()
-        else:
-            tag_id = db.execute(select(Tag.id).where(Tag.name == tag.name)).scalar()
-            try:
-                db.execute(insert(tag_assoc_table).values(post_id=post_id, tag_id=tag_id))
-                db.commit()
-            except IntegrityError:
-                db.rollback()
-    old_tags = db.execute(select(Post).where(Post.id == post_id)).scalar().tags
-    tag_names = [tag.name for tag in tags]
-    for old_tag in old_tags:
-        if old_tag.name not in tag_names:
-            db.execute(
-                delete(tag_assoc_table).where(Post.id == post_id).where(Tag.id == old_tag.id)
+def invalidate_post(*slugs: str):
+    """Drops cached page data for the given post slugs and bumps the content version"""
+    for slug in slugs:
+        post_cache.pop(slug)
+    content_version.bump()
+
+
+def tag_handler(db: Session, tags: list[Tag], post_id: int):
+    """
+    Syncs the post's tags with the given list, creating any tags that don't exist yet\n
+    Runs as three set-based statements and leaves committing to the caller
+    """
+    tag_names = sorted({tag.name for tag in tags})
+    if tag_names:
+        db.execute(
+            pg_insert(Tag)
+            .values([{"name": name} for name in tag_names])
+            .on_conflict_do_nothing(index_elements=[Tag.name])
+        )
+        db.execute(
+            pg_insert(tag_assoc_table)
+            .from_select(
+                ["post_id", "tag_id"],
+                select(literal(post_id), Tag.id).where(Tag.name.in_(tag_names)),
             )
-            db.commit()
+            .on_conflict_do_nothing()
+        )
+    db.execute(
+        delete(tag_assoc_table)
+        .where(tag_assoc_table.c.post_id == post_id)
+        .where(tag_assoc_table.c.tag_id.not_in(select(Tag.id).where(Tag.name.in_(tag_names))))
+    )
 
 
 def create_post(db: Session, post: schema.PostCreate, tags: list[Tag]):
@@ -42,8 +61,11 @@ def create_post(db: Session, post: schema.PostCreate, tags: list[Tag]):
     """
     obj = Post(**post)
     db.add(obj)
+    db.flush()
+    tag_handler(db=db, tags=tags, post_id=obj.id)
+    index_post(db=db, post_id=obj.id)
     db.commit()
-    tag_handler(db=db, tags=tags, post=obj)
+    invalidate_post(obj.slug)
     return obj
 
 
@@ -51,9 +73,53 @@ def get_all_posts(db: Session):
     return db.execute(select(Post)).scalars()
 
 
+def encode_cursor(post: Post) -> str:
+    """Encodes the keyset position of a post as an opaque pagination cursor"""
+    key = f"{post.date_posted.isoformat()}|{post.id}"
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """Raises ValueError if the cursor is malformed"""
+    date_posted, post_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return datetime.fromisoformat(date_posted), int(post_id)
+
+
+def get_posts_page(db: Session, limit: int, cursor: str = None, tag: str = None):
+    """
+    Returns a page of posts, newest first, with authors and tags loaded, and the cursor
+    for the following page (None on the last page)
+
+    Pages are keyed on (date_posted, id) so cost doesn't grow with the page number.
+    Optionally restricted to posts with the given tag name
+    """
+    stmt = select(Post).options(joinedload(Post.author), selectinload(Post.tags))
+    if tag is not None:
+        stmt = (
+            stmt.join(tag_assoc_table, tag_assoc_table.c.post_id == Post.id)
+            .join(Tag, Tag.id == tag_assoc_table.c.tag_id)
+            .where(Tag.name == tag)
+        )
+    if cursor is not None:
+        stmt = stmt.where(tuple_(Post.date_posted, Post.id) < tuple_(*decode_cursor(cursor)))
+    stmt = stmt.order_by(Post.date_posted.desc(), Post.id.desc()).limit(limit + 1)
+    posts = db.execute(stmt).scalars().all()
+    next_cursor = encode_cursor(posts[limit - 1]) if len(posts) > limit else None
+    return posts[:limit], next_cursor
+
+
 def get_recent_posts(db: Session, limit: int):
-    posts = sorted(db.execute(select(Post)).scalars(), key=lambda x: x.date_posted, reverse=True)
-    return posts[:limit]
+    """
+    Returns the newest posts as rows holding only the fields shown in post listings,
+    newest first
+    """
+    stmt = (
+        select(Post.slug, Post.title, Post.date_posted, Post.description, User.username)
+        .join(User, Post.user_id == User.id)
+        .order_by(Post.date_posted.desc())
+        .limit(limit)
+    )
+    return db.execute(stmt).all()
 
 
 def get_post(db: Session, slug: str) -> Post:
@@ -63,6 +129,55 @@ def get_post(db: Session, slug: str) -> Post:
     return db.execute(select(Post).where(Post.slug == slug)).scalar()
 
 
+def scan_post_assets(slug: str) -> dict:
+    """
+    Locates a post's header image and article HTML and hashes the article\n
+    Only called when post content is written, so reads never touch the post directory
+    """
+    content_path = Path(f"./static/posts/{slug}/")
+    assets = {"image_path": None, "article_path": None, "content_hash": None}
+    for file in content_path.iterdir():
+        if file.stem == "headerImage":
+            assets["image_path"] = str(Path(*file.parts[1:]))
+        elif file.suffix == ".html":
+            assets["article_path"] = str(file)
+            assets["content_hash"] = hashlib.sha256(file.read_bytes()).hexdigest()
+    return assets
+
+
+def set_post_assets(db: Session, post_id: int, slug: str):
+    # Slug is set explicitly as its onupdate default needs the title
+    db.execute(update(Post).where(Post.id == post_id).values(slug=slug, **scan_post_assets(slug)))
+    index_post(db=db, post_id=post_id)
+    db.commit()
+
+
+def build_header_variants(post_id: int):
+    """Background task generating the responsive variants of a post's header image"""
+    with session_scope() as db:
+        image_path = db.execute(select(Post.image_path).where(Post.id == post_id)).scalar()
+    if image_path is None:
+        return
+    # The session is closed while encoding so it doesn't hold a pooled connection
+    try:
+        variants = images.header_variants(Path(images.STATIC_DIR).joinpath(image_path))
+    except FileNotFoundError:
+        # Post was renamed or deleted meanwhile, its new image gets its own task
+        return
+    with session_scope() as db:
+        # Setting slug to itself stops its onupdate default from firing
+        slug = db.execute(
+            update(Post)
+            .where(Post.id == post_id)
+            .where(Post.image_path == image_path)
+            .values(slug=Post.slug, image_variants=variants)
+            .returning(Post.slug)
+        ).scalar()
+        db.commit()
+    if slug is not None:
+        invalidate_post(slug)
+
+
 def get_post_data(db: Session, post_id: int = None, slug: str = None) -> dict:
     if slug:
         obj: Post = db.execute(select(Post).where(Post.slug == slug)).scalar()
@@ -70,29 +185,130 @@ def get_post_data(db: Session, post_id: int = None, slug: str = None) -> dict:
         obj: Post = db.execute(select(Post).where(Post.id == post_id)).scalar()
     if not obj:
         return None
-    content_path = Path(f"./static/posts/{obj.slug}/")
-    for file in content_path.iterdir():
-        if "headerImage" in file.name:
-            img = str(Path(*file.parts[1:]))
-        if ".html" in file.name:
-            article = file
-    return {"post_obj": obj, "img_path": img, "article_path": article, "content_path": content_path}
+    if obj.article_path is None:
+        # Posts published before asset paths were recorded
+        set_post_assets(db=db, post_id=obj.id, slug=obj.slug)
+    return {
+        "post_obj": obj,
+        "img_path": obj.image_path,
+        "article_path": Path(obj.article_path),
+        "content_path": Path(f"./static/posts/{obj.slug}/"),
+    }
+
+
+def get_post_page(db: Session, slug: str) -> dict:
+    """
+    Returns the post snapshot, article HTML and header image path for the post page,
+    serving from the post cache when possible. Returns None if the post doesn't exist
+    """
+    # Entries built under an older content version were invalidated by another worker
+    version = content_version.value
+    cached = post_cache.get(slug)
+    page = cached[1] if cached is not None and cached[0] == version else None
+    if page is None:
+        post = get_post_data(db=db, slug=slug)
+        if not post:
+            return None
+        with open(post["article_path"]) as f:
+            content = f.read()
+        page = {
+            "article": schema.PostPage.from_orm(post["post_obj"]),
+            "article_content": content,
+            "img_path": post["img_path"],
+        }
+        post_cache.set(slug, (version, page))
+    return page
 
 
 def del_post(db: Session, slug: str):
     post_id = db.execute(select(Post.id).where(Post.slug == slug)).scalar()
-    db.execute(delete(tag_assoc_table).where(Post.id == post_id))
+    db.execute(delete(tag_assoc_table).where(tag_assoc_table.c.post_id == post_id))
     db.execute(delete(Post).where(Post.slug == slug))
     db.commit()
+    invalidate_post(slug)
     shutil.rmtree(Path(f"./static/posts/{slug}"))
 
 
 def edit_post(db: Session, post_id: int, data: dict, tags: list[Tag] = []):
+    old_slug = db.execute(select(Post.slug).where(Post.id == post_id)).scalar()
     db.execute(update(Post).where(Post.id == post_id).values(**data))
-    db.commit()
     if tags:
-        post = db.execute(select(Post).where(Post.id == post_id)).scalar()
-        tag_handler(db=db, tags=tags, post=post)
+        tag_handler(db=db, tags=tags, post_id=post_id)
+    index_post(db=db, post_id=post_id)
+    db.commit()
+    invalidate_post(old_slug, data.get("slug", old_slug))
+
+
+# Search
+def _weighted(text, weight: str):
+    return func.setweight(func.to_tsvector(config.SEARCH_CONFIG, func.coalesce(text, "")), weight)
+
+
+def index_post(db: Session, post_id: int):
+    """
+    Rebuilds the post's search vector from its current title, description, keywords and
+    article, ranking matches in that order\n
+    Sees uncommitted changes, so it's run at the end of the write's transaction
+    """
+    article_path = db.execute(select(Post.article_path).where(Post.id == post_id)).scalar()
+    text = ""
+    if article_path is not None:
+        with open(article_path) as f:
+            text = BeautifulSoup(f.read(), "html.parser").get_text(" ")
+    search_vector = (
+        _weighted(Post.title, "A")
+        .op("||")(_weighted(Post.description, "B"))
+        .op("||")(_weighted(Post.keywords, "B"))
+        .op("||")(_weighted(literal(text), "C"))
+    )
+    # Slug is set to itself as its onupdate default needs the title
+    db.execute(
+        update(Post).where(Post.id == post_id).values(slug=Post.slug, search_vector=search_vector)
+    )
+
+
+def index_missing_posts():
+    """Builds search vectors for posts published before search existed"""
+    with session_scope() as db:
+        post_ids = db.execute(select(Post.id).where(Post.search_vector == None)).scalars().all()
+        for post_id in post_ids:
+            index_post(db=db, post_id=post_id)
+        db.commit()
+
+
+def search_posts(db: Session, query: str, limit: int, offset: int = 0):
+    """
+    Returns a page of posts matching a web-style search query, best match first, as rows
+    holding the fields shown in post listings, and whether there are more results
+    """
+    tsquery = func.websearch_to_tsquery(config.SEARCH_CONFIG, query)
+    rank = func.ts_rank_cd(Post.search_vector, tsquery)
+    stmt = (
+        select(Post.slug, Post.title, Post.date_posted, Post.description, User.username)
+        .join(User, Post.user_id == User.id)
+        .where(Post.search_vector.op("@@")(tsquery))
+        .order_by(rank.desc(), Post.date_posted.desc(), Post.id.desc())
+        .offset(offset)
+        .limit(limit + 1)
+    )
+    rows = db.execute(stmt).all()
+    return rows[:limit], len(rows) > limit
+
+
+def suggest_posts(db: Session, text: str, limit: int = 10):
+    """Returns the ID and title of posts matching every word of partially typed text"""
+    words = re.findall(r"[^\W_]+", text)
+    if not words:
+        return []
+    # Each word is matched as a prefix so results show up while it's still being typed
+    tsquery = func.to_tsquery(config.SEARCH_CONFIG, " & ".join(f"{word}:*" for word in words))
+    stmt = (
+        select(Post.id, Post.title)
+        .where(Post.search_vector.op("@@")(tsquery))
+        .order_by(func.ts_rank_cd(Post.search_vector, tsquery).desc(), Post.title)
+        .limit(limit)
+    )
+    return db.execute(stmt).all()
 
 
 # Tags
@@ -113,16 +329,32 @@ def get_all_tags(db: Session):
     return db.execute(select(Tag)).scalars()
 
 
+def get_tag(db: Session, name: str) -> Tag:
+    return db.execute(select(Tag).where(Tag.name == name)).scalar()
+
+
 # User
 def get_user(db: Session, username: str):
     return db.execute(select(User).where(User.username == username)).scalar()
 
 
-def get_all_users(db: Session):
-    return db.execute(select(User)).scalars()
+async def get_user_by_email(db: AsyncSession, email: str):
+    return (await db.execute(select(User).where(User.email == email))).scalar()
+
+
+async def get_all_users(db: AsyncSession):
+    return (await db.execute(select(User))).scalars().all()
+
+
+def invalidate_user(username: str):
+    """Drops cached principals for the user, and through the user version those cached by other
+    workers, so their next request is verified again"""
+    principal_cache.pop_where(lambda entry: entry[1].username == username)
+    user_version.bump()
 
 
 # Admin
-def update_scopes(db: Session, username: str, scopes: list[str]):
-    db.execute(update(User).values(scopes=scopes).where(User.username == username))
-    db.commit()
+async def update_scopes(db: AsyncSession, username: str, scopes: list[str]):
+    await db.execute(update(User).values(scopes=scopes).where(User.username == username))
+    await db.commit()
+    await run_in_threadpool(invalidate_user, username)
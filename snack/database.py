@@ -1,11 +1,141 @@
-from sqlalchemy import create_engine
+from contextlib import asynccontextmanager, contextmanager
+
+from sqlalchemy import create_engine, event, func, inspect, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-from snack.config import DATABASE_URL
+from snack import config
+
+POOL_OPTIONS = {
+    "pool_size": config.DB_POOL_SIZE,
+    "max_overflow": config.DB_MAX_OVERFLOW,
+    "pool_timeout": config.DB_POOL_TIMEOUT,
+    "pool_pre_ping": config.DB_POOL_PRE_PING,
+    "pool_recycle": config.DB_POOL_RECYCLE,
+}
 
-engine = create_engine(DATABASE_URL, future=True)
+engine = create_engine(config.DATABASE_URL, future=True, **POOL_OPTIONS)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# For async routes, so queries don't block the event loop
+async_engine = create_async_engine(config.ASYNC_DATABASE_URL, future=True, **POOL_OPTIONS)
+
+AsyncSessionLocal = sessionmaker(
+    bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
+
 Base = declarative_base()
+
+
+# Pool monitoring
+_pool_counters = {}
+
+
+def _track_pool(sync_engine: Engine):
+    counters = _pool_counters[sync_engine] = {
+        "connects": 0,
+        "checkouts": 0,
+        "invalidations": 0,
+        "timeouts": 0,
+    }
+
+    def count(name):
+        def listener(*args):
+            counters[name] += 1
+
+        return listener
+
+    event.listen(sync_engine, "connect", count("connects"))
+    event.listen(sync_engine, "checkout", count("checkouts"))
+    event.listen(sync_engine, "invalidate", count("invalidations"))
+
+
+_track_pool(engine)
+_track_pool(async_engine.sync_engine)
+
+
+def pool_stats(sync_engine: Engine) -> dict:
+    """Returns live connection counts and lifetime counters for an engine's pool"""
+    pool = sync_engine.pool
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "saturated": pool.checkedout() >= pool.size() + config.DB_MAX_OVERFLOW,
+        **_pool_counters[sync_engine],
+    }
+
+
+# Sessions
+@contextmanager
+def session_scope():
+    """Provides a session that is rolled back on error and always closed"""
+    db = SessionLocal()
+    try:
+        yield db
+    except PoolTimeoutError:
+        _pool_counters[engine]["timeouts"] += 1
+        raise
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+@asynccontextmanager
+async def async_session_scope():
+    """Async counterpart to session_scope"""
+    db = AsyncSessionLocal()
+    try:
+        yield db
+    except PoolTimeoutError:
+        _pool_counters[async_engine.sync_engine]["timeouts"] += 1
+        raise
+    except Exception:
+        await db.rollback()
+        raise
+    finally:
+        await db.close()
+
+
+# Schema
+# Key of the advisory lock serializing init_db across workers
+_SCHEMA_LOCK = 0x736E61636B
+
+
+def _add_missing_columns(conn):
+    """Adds columns defined on the models but missing from existing tables.
+    New columns must be nullable, as existing rows are left empty."""
+    inspector = inspect(conn)
+    preparer = engine.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            conn.execute(
+                text(
+                    f"ALTER TABLE {preparer.format_table(table)} "
+                    f"ADD COLUMN {preparer.format_column(column)} {column_type}"
+                )
+            )
+
+
+def init_db():
+    """Creates missing tables, then any columns and indexes missing from existing tables\n
+    Every worker runs this on boot, so it's done in one transaction holding an advisory lock,
+    and each worker only inspects the schema once the one before it has committed"""
+    with engine.begin() as conn:
+        conn.execute(select(func.pg_advisory_xact_lock(_SCHEMA_LOCK)))
+        Base.metadata.create_all(bind=conn)
+        _add_missing_columns(conn)
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
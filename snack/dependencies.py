@@ -1,17 +1,20 @@
 from fastapi.exceptions import HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from snack import crud
 from snack.bookclub.crud import get_book, get_poll
-from snack.database import SessionLocal
+from snack.database import async_session_scope, session_scope
 
 
 def get_db():
-    try:
-        db = SessionLocal()
+    with session_scope() as db:
+        yield db
+
+
+async def get_async_db():
+    async with async_session_scope() as db:
         yield db
-    finally:
-        db.close()
 
 
 def get_post_obj(db: Session, slug: str):
@@ -21,15 +24,15 @@ def get_post_obj(db: Session, slug: str):
     return obj
 
 
-def get_poll_obj(db: Session, poll_id: int):
-    obj = get_poll(db, poll_id)
+async def get_poll_obj(db: AsyncSession, poll_id: int):
+    obj = await get_poll(db, poll_id)
     if obj is None:
         raise HTTPException(status_code=404, detail="Poll not found")
     return obj
 
 
-def get_book_obj(db: Session, book_id: int):
-    obj = get_book(db, book_id)
+async def get_book_obj(db: AsyncSession, book_id: int):
+    obj = await get_book(db, book_id)
     if obj is None:
         raise HTTPException(status_code=404, detail="Book not found")
     return obj
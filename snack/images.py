@@ -0,0 +1,97 @@
+import hashlib
+import os
+import re
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image, ImageOps
+
+STATIC_DIR = "static"
+STATIC_URL = "/static"
+
+COVER_DIR = "covers"
+COVER_WIDTHS = (150, 400)  # Poll/list thumbnail and book page
+
+HEADER_WIDTHS = (480, 960, 1440, 1920)
+
+# Encoder settings for each output format, keyed by file extension
+ENCODINGS = {
+    "webp": {"format": "WEBP", "quality": 80, "method": 4},
+    "jpg": {"format": "JPEG", "quality": 85, "optimize": True, "progressive": True},
+}
+
+# <hash>-<width>.<ext> or <stem>-<hash>-<width>.<ext>, where the hash is of the source image
+_VARIANT_NAME = re.compile(rf"(?:^|-)[0-9a-f]{{8,16}}-\d+\.(?:{'|'.join(ENCODINGS)})$")
+
+
+def write_variants(source: bytes, widths: tuple[int], directory: str, stem: str) -> dict:
+    """
+    Writes the image resized to each width, in every format in ENCODINGS, to directory as
+    <stem>-<width>.<ext>\n
+    Images are never upscaled, and files that already exist are skipped, so the image is only
+    decoded if something is missing. Metadata isn't carried over to the variants.
+    Returns {ext: {width: filename}}
+    """
+    image = Image.open(BytesIO(source))
+    # Header is read lazily, so this doesn't decode the image
+    targets = sorted({min(width, image.width) for width in widths})
+    variants = {ext: {} for ext in ENCODINGS}
+    decoded = None
+    for width in targets:
+        resized = None
+        for ext, options in ENCODINGS.items():
+            name = f"{stem}-{width}.{ext}"
+            variants[ext][str(width)] = name
+            path = os.path.join(directory, name)
+            if os.path.exists(path):
+                continue
+            if decoded is None:
+                # Apply EXIF orientation before the EXIF data is dropped
+                decoded = ImageOps.exif_transpose(image).convert("RGB")
+            if resized is None:
+                height = round(decoded.height * width / decoded.width)
+                resized = decoded.resize((width, height), Image.LANCZOS)
+            tmp_path = f"{path}.tmp"
+            resized.save(tmp_path, **options)
+            os.replace(tmp_path, path)
+    return variants
+
+
+def cover_variants(image_path: str) -> dict:
+    """
+    Builds the resized variants of a book cover, named by content hash so identical covers
+    share files. Returns {ext: {width: path}} with paths relative to the static directory
+    """
+    with open(image_path, "rb") as f:
+        source = f.read()
+    digest = hashlib.sha256(source).hexdigest()[:16]
+    directory = os.path.join(STATIC_DIR, COVER_DIR)
+    os.makedirs(directory, exist_ok=True)
+    variants = write_variants(source, COVER_WIDTHS, directory, digest)
+    return {
+        ext: {width: f"/{COVER_DIR}/{name}" for width, name in files.items()}
+        for ext, files in variants.items()
+    }
+
+
+def header_variants(image_path: Path) -> dict:
+    """
+    Builds the resized variants of a post's header image next to it, tagged with a hash of the
+    source so a replaced image never reuses old files. Returns {ext: {width: filename}}
+    """
+    source = image_path.read_bytes()
+    stem = f"{image_path.stem}-{hashlib.sha256(source).hexdigest()[:8]}"
+    return write_variants(source, HEADER_WIDTHS, image_path.parent, stem)
+
+
+def is_variant(path: str) -> bool:
+    """Whether the file is a resized variant, whose name changes whenever its content would"""
+    return _VARIANT_NAME.search(os.path.basename(path)) is not None
+
+
+def srcset(variants: dict, ext: str, base: str = "") -> str:
+    """Template filter formatting one format's variants as a srcset attribute value"""
+    if not variants:
+        return ""
+    files = sorted(variants.get(ext, {}).items(), key=lambda item: int(item[0]))
+    return ", ".join(f"{STATIC_URL}{base}{path} {width}w" for width, path in files)
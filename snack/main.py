@@ -2,13 +2,23 @@ import html
 import json
 import os
 import shutil
-import subprocess
 from datetime import datetime, timedelta
 from pathlib import Path
 from secrets import token_hex
 
 import filetype
-from fastapi import Body, Depends, FastAPI, File, Form, Query, Request, Security, status
+from fastapi import (
+    BackgroundTasks,
+    Body,
+    Depends,
+    FastAPI,
+    File,
+    Form,
+    Query,
+    Request,
+    Security,
+    status,
+)
 from fastapi.exceptions import HTTPException, RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.docs import get_swagger_ui_html
@@ -21,21 +31,25 @@ from fastapi.responses import (
     Response,
 )
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
 from pydantic import ValidationError
 from slugify import slugify
 from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
-from snack import auth, config, crud, schema
+from snack import assets, auth, conditional, config, crud, schema, templating
 from snack.bookclub import crud as club_crud
+from snack.bookclub import live, scraper
 from snack.bookclub.models import Poll
-from snack.database import Base, SessionLocal, engine
-from snack.dependencies import get_db, get_post_obj
+from snack.cache import content_version, fragment_cache, init_versions, post_cache, principal_cache
+from snack.compression import CompressionMiddleware
+from snack.database import async_engine, engine, init_db, pool_stats
+from snack.dependencies import get_async_db, get_db, get_post_obj
 from snack.models import Tag, User
+from snack.render import render_article
 from snack.routers import bookclub
+from snack.templating import templates
 
 
 def get_application():
@@ -56,16 +70,26 @@ def get_application():
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=config.COMPRESSION_MIN_SIZE,
+        gzip_level=config.GZIP_LEVEL,
+        brotli_quality=config.BROTLI_QUALITY,
+    )
 
-    app.mount("/static", StaticFiles(directory="static"), name="static")
+    app.mount("/static", assets.StaticAssets(directory="static"), name="static")
+
+    app.add_event_handler("startup", templating.precompile)
+    app.add_event_handler("startup", crud.index_missing_posts)
+    app.add_event_handler("shutdown", scraper.close_client)
     return app
 
 
 app = get_application()
 
-Base.metadata.create_all(bind=engine)
+init_db()
+init_versions()
 
-templates = Jinja2Templates(directory="templates")
 
 # Exception Handlers
 @app.exception_handler(RequestValidationError)
@@ -73,6 +97,8 @@ templates = Jinja2Templates(directory="templates")
 @app.exception_handler(HTTPException)
 @app.exception_handler(StarletteHTTPException)
 async def http_exception_handler(request, exc):
+    # Keeps headers the exception was raised with, such as Retry-After on a 503
+    headers = getattr(exc, "headers", None)
     try:
         if exc.status_code == 401:
             response = RedirectResponse(url="/login", status_code=303)
@@ -80,23 +106,26 @@ async def http_exception_handler(request, exc):
             return response
         if exc.status_code == 403:
             return templates.TemplateResponse(
-                "403.html", {"request": request, "exc": exc}, status_code=403
+                "403.html", {"request": request, "exc": exc}, status_code=403, headers=headers
             )
         if exc.status_code == 404:
             return templates.TemplateResponse(
-                "404.html", {"request": request, "exc": exc}, status_code=404
+                "404.html", {"request": request, "exc": exc}, status_code=404, headers=headers
             )
         if exc.status_code == 422:
             return templates.TemplateResponse(
-                "422.html", {"request": request, "exc": exc}, status_code=422
+                "422.html", {"request": request, "exc": exc}, status_code=422, headers=headers
             )
         if exc.status_code == 500:
             return templates.TemplateResponse(
-                "500.html", {"request": request, "exc": exc}, status_code=500
+                "500.html", {"request": request, "exc": exc}, status_code=500, headers=headers
             )
         else:
             return templates.TemplateResponse(
-                "error.html", {"request": request, "exc": exc}, status_code=exc.status_code
+                "error.html",
+                {"request": request, "exc": exc},
+                status_code=exc.status_code,
+                headers=headers,
             )
     except AttributeError:
         return templates.TemplateResponse(
@@ -104,13 +133,37 @@ async def http_exception_handler(request, exc):
         )
 
 
+# Pagination
+def get_posts_page(request: Request, db: Session, cursor: str = None, tag: str = None):
+    """Returns a page of posts and the URL of the next page, if there is one"""
+    try:
+        posts, next_cursor = crud.get_posts_page(
+            db=db, limit=config.POSTS_PER_PAGE, cursor=cursor, tag=tag
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid page cursor")
+    next_url = None
+    if next_cursor is not None:
+        next_url = str(request.url.include_query_params(cursor=next_cursor))
+    return posts, next_url
+
+
+def set_next_link(response: Response, next_url: str = None) -> Response:
+    if next_url is not None:
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    return response
+
+
 # Main Pages
 @app.get("/", response_class=HTMLResponse)
 def root(request: Request, db: Session = Depends(get_db)):
+    if cached := conditional.not_modified(request):
+        return cached
     posts = crud.get_recent_posts(db=db, limit=10)
-    return templates.TemplateResponse(
+    response = templates.TemplateResponse(
         "home.html", {"request": request, "title": "Home", "posts": posts}
     )
+    return conditional.set_validators(request, response)
 
 
 @app.get("/about", response_class=HTMLResponse)
@@ -132,9 +185,13 @@ def login(request: Request):
 
 
 @app.post("/login", response_class=RedirectResponse)
-def login(response: Response, form_data: OAuth2PasswordRequestForm = Depends()):
-    user = auth.authenticate_user(
-        username=form_data.username, password=form_data.password, db=SessionLocal()
+async def login(
+    response: Response,
+    form_data: OAuth2PasswordRequestForm = Depends(),
+    db: AsyncSession = Depends(get_async_db),
+):
+    user = await auth.authenticate_user(
+        username=form_data.username, password=form_data.password, db=db
     )
     if not user:
         raise HTTPException(
@@ -183,11 +240,12 @@ def register(request: Request):
 
 
 @app.post("/register", response_class=RedirectResponse)
-def register(
+async def register(
     username: str = Form(...),
     email: str = Form(...),
     password: str = Form(...),
     confirm_password: str = Form(...),
+    db: AsyncSession = Depends(get_async_db),
 ):
     verify_data = {
         "username": username,
@@ -195,26 +253,32 @@ def register(
         "password": password,
         "confirm_password": confirm_password,
     }
-    hashed_password = auth.get_password_hash(password)
-    user_data = {"username": username, "email": email, "password": hashed_password}
     try:
         schema.UserCreate(**verify_data)
-        user = User(**user_data)
-        db = SessionLocal()
-        db.add(user)
-        db.commit()
-        response = RedirectResponse(url="/register", status_code=303)
-        response.delete_cookie(key="Errors")
-        response.set_cookie(key="Success", value=user.username, max_age=30, expires=30)
-        return response
+        errors = []
     except ValidationError as exception:
         errors = [error["msg"] for error in exception.errors()]
+    if await auth.get_user(db=db, username=username):
+        errors.append("Username already exists")
+    if await crud.get_user_by_email(db=db, email=email):
+        errors.append("Email already exists")
+
+    if errors:
         error_str = ":".join(errors)
         response = RedirectResponse(url="/register", status_code=303)
         response.delete_cookie(key="Success")
         response.set_cookie(key="Errors", value=error_str, max_age=30, expires=30)
         return response
 
+    hashed_password = await auth.get_password_hash(password)
+    user = User(username=username, email=email, password=hashed_password)
+    db.add(user)
+    await db.commit()
+    response = RedirectResponse(url="/register", status_code=303)
+    response.delete_cookie(key="Errors")
+    response.set_cookie(key="Success", value=user.username, max_age=30, expires=30)
+    return response
+
 
 # Users
 @app.get("/users/{username}", response_class=HTMLResponse)
@@ -224,9 +288,46 @@ def read_current_user(request: Request, username: str, db: Session = Depends(get
 
 
 @app.get("/posts/all", response_class=HTMLResponse)
-def get_all_posts(request: Request, db: Session = Depends(get_db)):
-    posts = crud.get_all_posts(db=db)
-    return templates.TemplateResponse("postlist.html", {"request": request, "posts": posts})
+def get_all_posts(request: Request, cursor: str = None, db: Session = Depends(get_db)):
+    if cached := conditional.not_modified(request):
+        return cached
+    # Only queried when the rendered list isn't cached
+    fragment = templating.Fragment(f"postlist:{request.url}", content_version.value)
+    posts = None
+    if fragment.missing:
+        posts, fragment.data["next_url"] = get_posts_page(request=request, db=db, cursor=cursor)
+    next_url = fragment.data["next_url"]
+    response = templates.TemplateResponse(
+        "postlist.html",
+        {"request": request, "fragment": fragment, "posts": posts, "next_url": next_url},
+    )
+    return conditional.set_validators(request, set_next_link(response, next_url))
+
+
+@app.get("/search", response_class=HTMLResponse)
+def search(
+    request: Request,
+    q: str = Query("", max_length=200),
+    page: int = Query(1, ge=1),
+    db: Session = Depends(get_db),
+):
+    if cached := conditional.not_modified(request):
+        return cached
+    posts, next_url = [], None
+    if q.strip():
+        posts, more = crud.search_posts(
+            db=db,
+            query=q,
+            limit=config.POSTS_PER_PAGE,
+            offset=(page - 1) * config.POSTS_PER_PAGE,
+        )
+        if more:
+            next_url = str(request.url.include_query_params(page=page + 1))
+    response = templates.TemplateResponse(
+        "search.html",
+        {"request": request, "title": "Search", "query": q, "posts": posts, "next_url": next_url},
+    )
+    return conditional.set_validators(request, set_next_link(response, next_url))
 
 
 # CRUD
@@ -244,18 +345,9 @@ def del_post(slug: str, db: Session = Depends(get_db)):
     response_class=HTMLResponse,
     dependencies=[Security(auth.verify_token, scopes=["admin"])],
 )
-async def admin(request: Request, db: Session = Depends(get_db)):
-    users = crud.get_all_users(db)
-    polls = club_crud.get_all_polls(db)
-    polls = [
-        {
-            "date": datetime.strptime(str(poll.date), "%Y%m").strftime("%B %Y"),
-            "id": poll.id,
-            "primary": poll.primary,
-        }
-        for poll in polls
-        if not poll.finished
-    ]
+async def admin(request: Request, db: AsyncSession = Depends(get_async_db)):
+    users = await crud.get_all_users(db)
+    polls = await club_crud.get_open_polls(db)
 
     return templates.TemplateResponse(
         "admin.html", {"request": request, "users": users, "polls": polls}
@@ -267,13 +359,33 @@ async def admin(request: Request, db: Session = Depends(get_db)):
     response_class=RedirectResponse,
     dependencies=[Security(auth.verify_token, scopes=["admin"])],
 )
-async def update_scopes(request: Request, user: str = Form(...), db: Session = Depends(get_db)):
+async def update_scopes(
+    request: Request, user: str = Form(...), db: AsyncSession = Depends(get_async_db)
+):
     formdata = await request.form()
     scopes = [scope for scope in formdata if scope != "user"]
-    crud.update_scopes(username=user, scopes=scopes, db=db)
+    await crud.update_scopes(username=user, scopes=scopes, db=db)
     return RedirectResponse("/admin", status_code=303)
 
 
+@app.get(
+    "/admin/stats",
+    response_class=JSONResponse,
+    dependencies=[Security(auth.verify_token, scopes=["admin"])],
+)
+def get_stats():
+    return JSONResponse(
+        {
+            "post_cache": post_cache.stats(),
+            "principal_cache": principal_cache.stats(),
+            "fragment_cache": fragment_cache.stats(),
+            "db_pool": pool_stats(engine),
+            "async_db_pool": pool_stats(async_engine.sync_engine),
+            "live_poll_watchers": live.broadcaster.watchers(),
+        }
+    )
+
+
 @app.get(
     "/openapi.json",
     response_class=JSONResponse,
@@ -319,13 +431,18 @@ def escape_html(file: Path, unescape: bool = False):
     response_class=HTMLResponse,
     dependencies=[Security(auth.verify_token, scopes=["edit"])],
 )
-def search_posts(request: Request, db: Session = Depends(get_db)):
-    posts = [
-        {"title": post.title.replace('"', "'"), "id": post.id} for post in crud.get_all_posts(db=db)
-    ]
-    posts = sorted(posts, key=lambda x: x["title"])
-    posts = json.dumps(posts)
-    return templates.TemplateResponse("edit_search.html", {"request": request, "posts": posts})
+def search_posts(request: Request):
+    return templates.TemplateResponse("edit_search.html", {"request": request})
+
+
+@app.get(
+    "/posts/edit/search",
+    response_class=JSONResponse,
+    dependencies=[Security(auth.verify_token, scopes=["edit"])],
+)
+def suggest_posts(q: str = Query("", max_length=100), db: Session = Depends(get_db)):
+    posts = crud.suggest_posts(db=db, text=q)
+    return JSONResponse([{"id": post.id, "title": post.title} for post in posts])
 
 
 @app.post(
@@ -334,9 +451,10 @@ def search_posts(request: Request, db: Session = Depends(get_db)):
     dependencies=[Security(auth.verify_token, scopes=["edit"])],
 )
 def redir_edit(search: str = Form(...), db: Session = Depends(get_db)):
-    slug = slugify(search)
-    post = crud.get_post(slug=slug, db=db)
-    return RedirectResponse(f"/posts/edit/{post.id}")
+    posts = crud.suggest_posts(db=db, text=search, limit=1)
+    if not posts:
+        raise HTTPException(status_code=404, detail="Post not found")
+    return RedirectResponse(f"/posts/edit/{posts[0].id}", status_code=303)
 
 
 @app.get("/posts/edit/{post_id}", dependencies=[Security(auth.verify_token, scopes=["edit"])])
@@ -374,6 +492,8 @@ def submit_edit(post_id: int, tmp_id: str = Body(..., embed=True), db: Session =
     for file in tmp_dir.iterdir():
         shutil.move(file, article_path.joinpath(file.name))
     shutil.rmtree(tmp_dir)
+    crud.set_post_assets(db=db, post_id=post_id, slug=article_slug)
+    crud.invalidate_post(article_slug)
     return JSONResponse({"url": f"/posts/{article_slug}"})
 
 
@@ -399,6 +519,7 @@ def edit_post_info(request: Request, post_id: int, db: Session = Depends(get_db)
 )
 def update_post_info(
     post_id: int,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     img_file: bytes = File(None),
     title: str = Form(None),
@@ -418,6 +539,8 @@ def update_post_info(
         if not img_ext:
             img_ext = "png"
         os.remove(img_path)
+        for variant in Path(content_path).glob("headerImage-*"):
+            variant.unlink()
         img_path = Path(content_path).joinpath(f"headerImage.{img_ext}")
         with open(img_path, "wb") as f:
             f.write(img_file)
@@ -460,9 +583,15 @@ def update_post_info(
         "photographer_name": config["photographerName"],
         "photographer_url": config["photographerUrl"],
         "keywords": config["keywords"],
+        **crud.scan_post_assets(slug),
     }
+    if img_file:
+        data["image_variants"] = None
     tags = [Tag(name=tag.lower()) for tag in tag_list]
     crud.edit_post(db=db, post_id=post_id, data=data, tags=tags)
+    if img_file:
+        # Variants are stored by filename, so a rename alone keeps the existing ones
+        background_tasks.add_task(crud.build_header_variants, post_id)
     return RedirectResponse(
         url=f"/posts/{slugify(config['title'], max_length=20)}", status_code=303
     )
@@ -492,7 +621,7 @@ def upload(
     img_alt: str = Form(...),
     pg_name: str = Form(...),
     pg_url: str = Form(...),
-    user: User = Depends(auth.verify_token),
+    user: schema.Principal = Depends(auth.verify_token),
 ):
     tmp_dir = next(create_tmp())
 
@@ -527,13 +656,7 @@ def upload(
     with open(f"{tmp_dir}/article.md", "wb") as f:
         f.write(article_file)
     escape_html(file=(Path(f"{tmp_dir}/article.md")), unescape=True)
-
-    # This is absurd
-    cmd = f"""node -e 'require("static/src/md-html.js").convert("{tmp_dir}")'"""
-    subprocess.run(cmd, shell=True)
-
-    with open(f"{tmp_dir}/article.html") as f:
-        article_html = f.read()
+    article_html = render_article(tmp_dir)
 
     article = {
         "title": title,
@@ -572,7 +695,7 @@ def get_article_md(tmp_id: str):
 
 @app.post(
     "/edit/{tmp_id}",
-    response_class=FileResponse,
+    response_class=HTMLResponse,
     dependencies=[Security(auth.verify_token, scopes=["edit"])],
 )
 def convert_edit(tmp_id: str, article_md: bytes = File(...)):
@@ -581,11 +704,7 @@ def convert_edit(tmp_id: str, article_md: bytes = File(...)):
         f.write(article_md)
 
     escape_html(file=(Path(f"./static/tmp/{tmp_id}/article.md")), unescape=True)
-
-    # This is absurd
-    cmd = f"""node -e 'require("static/src/md-html.js").convert("{tmp_dir}")'"""
-    subprocess.run(cmd, shell=True)
-    return FileResponse(f"{tmp_dir}/article.html")
+    return HTMLResponse(render_article(tmp_dir))
 
 
 @app.post(
@@ -593,7 +712,7 @@ def convert_edit(tmp_id: str, article_md: bytes = File(...)):
     response_class=JSONResponse,
     dependencies=[Security(auth.verify_token, scopes=["post"])],
 )
-def submit_article(tmp_id: str, db: Session = Depends(get_db)):
+def submit_article(tmp_id: str, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
     tmp_dir = Path(f"./static/tmp/{tmp_id}")
     with open(f"{tmp_dir}/article.config.json") as f:
         article_config = json.load(f)
@@ -617,38 +736,61 @@ def submit_article(tmp_id: str, db: Session = Depends(get_db)):
         "photographer_name": article_config["photographerName"],
         "photographer_url": article_config["photographerUrl"],
         "keywords": article_config["keywords"],
+        **crud.scan_post_assets(article_slug),
     }
     tags = [Tag(name=tag.lower()) for tag in article_config["tags"]]
-    crud.create_post(db=db, post=data, tags=tags)
+    obj = crud.create_post(db=db, post=data, tags=tags)
+    background_tasks.add_task(crud.build_header_variants, obj.id)
     return JSONResponse({"url": f"/posts/{article_slug}"})
 
 
 # Post Pages
 @app.get("/posts/{slug}", response_class=HTMLResponse)
 def get_post(request: Request, slug: str, db: Session = Depends(get_db)):
-    post = crud.get_post_data(db=db, slug=slug)
-    if not post:
+    if cached := conditional.not_modified(request):
+        return cached
+    page = crud.get_post_page(db=db, slug=slug)
+    if not page:
         raise HTTPException(status_code=404, detail="Post not found")
-    article, img_path, article_path, content_path = post.values()
-    with open(article_path) as f:
-        content = f.read()
-    return templates.TemplateResponse(
-        "post.html",
-        {"request": request, "article": article, "article_content": content, "img_path": img_path},
-    )
+    response = templates.TemplateResponse("post.html", {"request": request, **page})
+    return conditional.set_validators(request, response)
 
 
 @app.get("/tags", response_class=HTMLResponse)
 def get_all_tags(request: Request, db: Session = Depends(get_db)):
-    tags = crud.get_all_tags(db=db)
-    return templates.TemplateResponse("taglist.html", {"request": request, "tags": tags})
+    if cached := conditional.not_modified(request):
+        return cached
+    fragment = templating.Fragment("taglist", content_version.value)
+    tags = crud.get_all_tags(db=db) if fragment.missing else None
+    response = templates.TemplateResponse(
+        "taglist.html", {"request": request, "fragment": fragment, "tags": tags}
+    )
+    return conditional.set_validators(request, response)
 
 
 @app.get("/tags/{tag}", response_class=HTMLResponse)
-def get_tags(request: Request, tag: str, db: Session = Depends(get_db)):
-    tag = db.execute(select(Tag).where(Tag.name == tag)).scalar()
-    if not tag:
-        raise HTTPException(status_code=404, detail="Tag not found")
-    else:
-        return templates.TemplateResponse("tag.html", {"request": request, "tag": tag})
+def get_tags(request: Request, tag: str, cursor: str = None, db: Session = Depends(get_db)):
+    if cached := conditional.not_modified(request):
+        return cached
+    fragment = templating.Fragment(f"tag:{request.url}", content_version.value)
+    posts = None
+    if fragment.missing:
+        tag = crud.get_tag(db=db, name=tag)
+        if not tag:
+            raise HTTPException(status_code=404, detail="Tag not found")
+        posts, fragment.data["next_url"] = get_posts_page(
+            request=request, db=db, cursor=cursor, tag=tag.name
+        )
+    next_url = fragment.data["next_url"]
+    response = templates.TemplateResponse(
+        "tag.html",
+        {
+            "request": request,
+            "fragment": fragment,
+            "tag": tag,
+            "posts": posts,
+            "next_url": next_url,
+        },
+    )
+    return conditional.set_validators(request, set_next_link(response, next_url))
 
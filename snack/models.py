@@ -3,15 +3,18 @@ from datetime import datetime
 from slugify import slugify
 from sqlalchemy import (
     ARRAY,
+    JSON,
     Boolean,
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     String,
     Table,
     UniqueConstraint,
 )
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.orm import relationship
 
 from snack.database import Base
@@ -25,7 +28,7 @@ tag_assoc_table = Table(
     "association",
     Base.metadata,
     Column("post_id", Integer, ForeignKey("posts.id")),
-    Column("tag_id", Integer, ForeignKey("tags.id")),
+    Column("tag_id", Integer, ForeignKey("tags.id"), index=True),
     UniqueConstraint("post_id", "tag_id"),
 )
 
@@ -40,7 +43,7 @@ class User(Base):
     scopes = Column(ARRAY(String), default=[])
     disabled = Column(Boolean, default=False)
 
-    posts = relationship("Post", backref="author", lazy=True)
+    posts = relationship("Post", back_populates="author", lazy=True)
 
     def __repr__(self):
         return f"User('{self.username}', '{self.email}')"
@@ -60,9 +63,23 @@ class Post(Base):
     photographer_name = Column(String)
     photographer_url = Column(String)
     keywords = Column(String)
-
+    # Recorded when content is written so reads don't need to scan the post directory
+    image_path = Column(String)
+    article_path = Column(String)
+    content_hash = Column(String(64))
+    image_variants = Column(JSON)  # {ext: {width: filename}} of resized header images
+    # Weighted title, description, keywords and article text, rebuilt whenever they change
+    search_vector = Column(TSVECTOR)
+
+    author = relationship("User", back_populates="posts")
     tags = relationship("Tag", secondary=tag_assoc_table, back_populates="posts")
 
+    # Serves both newest-first listings and keyset pagination on (date_posted, id)
+    __table_args__ = (
+        Index("ix_posts_date_posted_id", "date_posted", "id"),
+        Index("ix_posts_search_vector", "search_vector", postgresql_using="gin"),
+    )
+
     def __repr__(self):
         return f"Post('{self.title}', '{self.date_posted}')"
 
@@ -73,3 +90,12 @@ class Tag(Base):
     name = Column(String, nullable=False, unique=True)
 
     posts = relationship("Post", secondary=tag_assoc_table, back_populates="tags")
+
+
+class Version(Base):
+    """Content version counters, kept in the database so every worker sees each bump"""
+
+    __tablename__ = "versions"
+    name = Column(String(32), primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+    last_modified = Column(Integer, nullable=False)  # Unix time of the last bump
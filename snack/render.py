@@ -0,0 +1,52 @@
+import re
+import threading
+from pathlib import Path
+
+import markdown2
+
+# Mirrors the showdown converter options used by static/src/md-html.js
+EXTRAS = ["fenced-code-blocks", "header-ids", "highlightjs-lang", "tag-friendly"]
+
+_local = threading.local()
+
+# JavaScript's \w only matches ASCII
+_NON_WORD = re.compile(r"[^\w]", re.ASCII)
+
+
+class ArticleMarkdown(markdown2.Markdown):
+    """Markdown converter matching the showdown settings used for articles."""
+
+    def _encode_email_address(self, addr):
+        # showdown is configured with encodeEmails: false
+        return f'<a href="mailto:{addr}">{addr}</a>'
+
+    def header_id_from_text(self, text, prefix, n):
+        # showdown's default ids, so #anchor links keep working: "My Heading!" -> "myheading",
+        # with repeats numbered from 1
+        header_id = _NON_WORD.sub("", text).lower()
+        count = self._count_from_header_id[header_id]
+        self._count_from_header_id[header_id] += 1
+        return f"{header_id}-{count}" if count else header_id
+
+
+def _get_converter() -> ArticleMarkdown:
+    # Converters hold state while rendering, so each worker thread gets its own
+    converter = getattr(_local, "converter", None)
+    if converter is None:
+        converter = _local.converter = ArticleMarkdown(extras=EXTRAS)
+    return converter
+
+
+def markdown_to_html(text: str) -> str:
+    return _get_converter().convert(text)
+
+
+def render_article(tmp_dir: str) -> str:
+    """Converts article.md in the given directory, writing article.html alongside it.
+    Returns the rendered HTML."""
+    tmp_dir = Path(tmp_dir)
+    with open(tmp_dir.joinpath("article.md")) as f:
+        article_html = markdown_to_html(f.read())
+    with open(tmp_dir.joinpath("article.html"), "w") as f:
+        f.write(article_html)
+    return article_html
@@ -1,47 +1,47 @@
-from datetime import datetime
+import asyncio
+import csv
+import io
+import json
 
-from fastapi import APIRouter, Depends, Form, Request, Security
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
+import httpx
+from fastapi import APIRouter, Depends, File, Form, Request, Security, UploadFile
+from fastapi.exceptions import HTTPException
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
 from pydantic import ValidationError
-from snack import auth
-from snack.bookclub import crud, schema
-from snack.bookclub.models import Book
-from snack.bookclub.scraper import get_book_data
-from snack.dependencies import get_book_obj, get_db, get_poll_obj
-from sqlalchemy.orm import Session
+from snack import auth, config
+from snack.bookclub import crud, live, schema
+from snack.bookclub.scrape_cache import ScrapeCacheMiss, canonical_url
+from snack.bookclub.scraper import get_book_data, get_many_book_data
+from snack.cache import book_version
+from snack.database import async_session_scope
+from snack.dependencies import get_async_db, get_book_obj, get_poll_obj
+from snack.templating import Fragment, templates
+from sqlalchemy.ext.asyncio import AsyncSession
 
 router = APIRouter(
     prefix="/bookclub", dependencies=[Security(auth.verify_token, scopes=["bookclub"])]
 )
 
-templates = Jinja2Templates(directory="templates")
-
 
 @router.get("/", response_class=HTMLResponse)
-async def root(request: Request, db: Session = Depends(get_db)):
-    polls = crud.get_all_polls(db)
-    polls = [
-        {
-            "date": datetime.strptime(str(poll.date), "%Y%m").strftime("%B %Y"),
-            "id": poll.id,
-            "primary": poll.primary,
-        }
-        for poll in polls
-        if not poll.finished
-    ]
-
-    books = crud.get_all_books(db)
-    books = [
-        {"id": book.id, "title": book.title, "author": book.author}
-        for book in books
-        if not book.read and not book.veto and not book.current
-    ]
-
-    current = crud.get_current_book(db)
+async def root(request: Request, db: AsyncSession = Depends(get_async_db)):
+    # Only queried when the rendered overview isn't cached
+    fragment = Fragment("bookclub", await book_version.current())
+    polls = books = current = None
+    if fragment.missing:
+        polls = await crud.get_open_polls(db)
+        books = await crud.get_candidate_books(db)
+        current = await crud.get_current_book(db)
 
     response = templates.TemplateResponse(
-        "bookclub.html", {"request": request, "polls": polls, "books": books, "current": current}
+        "bookclub.html",
+        {
+            "request": request,
+            "fragment": fragment,
+            "polls": polls,
+            "books": books,
+            "current": current,
+        },
     )
     response.delete_cookie(key="BookSuccess")
     response.delete_cookie(key="BookErrors")
@@ -50,7 +50,9 @@ async def root(request: Request, db: Session = Depends(get_db)):
 
 # Books
 @router.post("/books/new", response_class=RedirectResponse)
-async def create_book(request: Request, url: str = Form(...), db: Session = Depends(get_db)):
+async def create_book(
+    request: Request, url: str = Form(...), db: AsyncSession = Depends(get_async_db)
+):
     response = RedirectResponse(url="/bookclub", status_code=303)
 
     # Validate URL, returning error cookie if invalid
@@ -62,24 +64,103 @@ async def create_book(request: Request, url: str = Form(...), db: Session = Depe
         response.set_cookie(key="BookErrors", value=error_str, max_age=30, expires=30)
         return response
 
-    book_data = await get_book_data(db, url)
-    book = Book(**book_data)
+    # Check for duplicates before going to Goodreads
+    url = canonical_url(url)
+    if await crud.get_book(db, source_url=url) is not None:
+        response.set_cookie(key="BookErrors", value="Book already exists", max_age=30, expires=30)
+        return response
+    # Ends the read so its pooled connection isn't held while Goodreads is fetched
+    await db.rollback()
+
+    try:
+        book_data = await get_book_data(url)
+    except (httpx.HTTPError, ScrapeCacheMiss):
+        response.set_cookie(
+            key="BookErrors", value="Could not fetch book from Goodreads", max_age=30, expires=30
+        )
+        return response
 
     # Return error if book exists in database
-    if crud.get_book(db, title=book.title) is not None:
+    if await crud.get_book(db, title=book_data["title"]) is not None:
         response.set_cookie(key="BookErrors", value="Book already exists", max_age=30, expires=30)
         return response
 
-    db.add(book)
-    db.commit()
+    # Goes through crud so cached bookclub fragments are invalidated
+    await crud.create_books(db, [book_data])
 
-    response.set_cookie(key="BookSuccess", value=book.title, max_age=30, expires=30)
+    response.set_cookie(key="BookSuccess", value=book_data["title"], max_age=30, expires=30)
     return response
 
 
+def _shelf_urls(shelf_csv: str) -> list[str]:
+    """Reads book URLs from a Goodreads library export."""
+    reader = csv.DictReader(io.StringIO(shelf_csv))
+    return [
+        f"https://www.goodreads.com/book/show/{row['Book Id']}"
+        for row in reader
+        if row.get("Book Id")
+    ]
+
+
+@router.post(
+    "/books/import",
+    response_class=JSONResponse,
+    dependencies=[Security(auth.verify_token, scopes=["admin"])],
+)
+async def import_books(
+    urls: str = Form(None),
+    shelf: UploadFile = File(None),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Adds books from whitespace separated Goodreads URLs and/or a Goodreads library export,
+    scraping concurrently and reporting the outcome for each URL."""
+    submitted = urls.split() if urls else []
+    if shelf is not None:
+        submitted += _shelf_urls((await shelf.read()).decode("utf-8-sig"))
+
+    report = []
+    candidates = []
+    for url in submitted:
+        try:
+            schema.BookURL(url=url)
+        except ValidationError as exception:
+            errors = [error["msg"] for error in exception.errors()]
+            report.append({"url": url, "status": "error", "detail": ":".join(errors)})
+            continue
+        url = canonical_url(url)
+        if url not in candidates:
+            candidates.append(url)
+
+    existing_urls = await crud.get_existing_source_urls(db, candidates)
+    to_scrape = [url for url in candidates if url not in existing_urls]
+    report += [{"url": url, "status": "exists"} for url in candidates if url in existing_urls]
+
+    # Ends the read so its pooled connection isn't held idle in transaction while scraping
+    await db.rollback()
+    results = await get_many_book_data(to_scrape)
+    titles = [result["title"] for result in results if isinstance(result, dict)]
+    existing_titles = await crud.get_existing_titles(db, titles)
+
+    new_books = []
+    for url, result in zip(to_scrape, results):
+        if isinstance(result, Exception):
+            detail = str(result) or type(result).__name__
+            report.append({"url": url, "status": "error", "detail": detail})
+        elif result["title"] in existing_titles:
+            report.append({"url": url, "status": "exists"})
+        else:
+            existing_titles.add(result["title"])
+            new_books.append(result)
+            report.append({"url": url, "status": "added", "title": result["title"]})
+
+    if new_books:
+        await crud.create_books(db, new_books)
+    return JSONResponse({"added": len(new_books), "results": report})
+
+
 @router.get("/books/{id}", response_class=HTMLResponse)
-async def get_book(request: Request, id: int, db: Session = Depends(get_db)):
-    book = get_book_obj(db, id)
+async def get_book(request: Request, id: int, db: AsyncSession = Depends(get_async_db)):
+    book = await get_book_obj(db, id)
     return templates.TemplateResponse("bookpage.html", {"request": request, "book": book})
 
 
@@ -89,12 +170,14 @@ async def get_book(request: Request, id: int, db: Session = Depends(get_db)):
     response_class=RedirectResponse,
     dependencies=[Security(auth.verify_token, scopes=["admin"])],
 )
-async def create_poll(request: Request, date: str = Form(...), db: Session = Depends(get_db)):
+async def create_poll(
+    request: Request, date: str = Form(...), db: AsyncSession = Depends(get_async_db)
+):
     date = int(date.replace("-", ""))
-    if crud.check_poll_exists(db, date):
+    if await crud.check_poll_exists(db, date):
         return RedirectResponse("/admin", status_code=303)
     poll = {"date": date, "primary": True}
-    crud.create_poll(db, poll)
+    await crud.create_poll(db, poll)
     return RedirectResponse("/admin", status_code=303)
 
 
@@ -103,20 +186,22 @@ async def create_poll(request: Request, date: str = Form(...), db: Session = Dep
     response_class=RedirectResponse,
     dependencies=[Security(auth.verify_token, scopes=["admin"])],
 )
-async def complete_poll(request: Request, id: int = Form(...), db: Session = Depends(get_db)):
-    crud.complete_poll(db, id)
+async def complete_poll(
+    request: Request, id: int = Form(...), db: AsyncSession = Depends(get_async_db)
+):
+    await crud.complete_poll(db, id)
     return RedirectResponse("/admin", status_code=303)
 
 
 @router.get("/polls/{id}", response_class=HTMLResponse)
-async def get_poll(request: Request, id: int, db: Session = Depends(get_db)):
+async def get_poll(request: Request, id: int, db: AsyncSession = Depends(get_async_db)):
     # Verify user hasn't already voted in this poll
-    if request.cookies.get("User") in crud.get_voters(db, id):
-        return RedirectResponse("/bookclub", status_code=303)
+    if request.cookies.get("User") in await crud.get_voters(db, id):
+        return RedirectResponse(f"/bookclub/polls/{id}/results", status_code=303)
 
-    poll = get_poll_obj(db, id)
+    poll = await get_poll_obj(db, id)
     poll = {
-        "date": datetime.strptime(str(poll.date), "%Y%m").strftime("%B %Y"),
+        "date": crud.format_poll_date(poll.date),
         "id": poll.id,
         "primary": poll.primary,
         "choices": poll.choices,
@@ -126,9 +211,63 @@ async def get_poll(request: Request, id: int, db: Session = Depends(get_db)):
     return templates.TemplateResponse(html, {"request": request, "poll": poll})
 
 
+@router.get("/polls/{id}/results", response_class=HTMLResponse)
+async def get_poll_results(request: Request, id: int, db: AsyncSession = Depends(get_async_db)):
+    """Current vote counts, kept up to date in the browser by the live stream"""
+    poll = await get_poll_obj(db, id)
+    poll = {
+        "date": crud.format_poll_date(poll.date),
+        "id": poll.id,
+        "primary": poll.primary,
+        "choices": sorted(poll.choices, key=lambda choice: (-choice.votes, choice.book.title)),
+    }
+    return templates.TemplateResponse("bookpoll_results.html", {"request": request, "poll": poll})
+
+
+def _event(name: str, data: dict) -> str:
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _tally_events(request: Request, poll_id: int):
+    # Subscribed before the tally is read, and every event carries absolute counts numbered by
+    # ballot, so a ballot counted in both is harmless and the page keeps whichever is newer
+    with live.broadcaster.subscribe(poll_id) as subscriber:
+        async with async_session_scope() as db:
+            tally = await crud.get_tally(db, poll_id)
+        if tally is None:
+            return
+        yield _event("tally", tally)
+        while True:
+            try:
+                tally = await asyncio.wait_for(subscriber.get(), config.LIVE_HEARTBEAT)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    return
+                # Comment line keeping proxies from closing an idle connection
+                yield ": heartbeat\n\n"
+                continue
+            if await request.is_disconnected():
+                return
+            yield _event("tally", tally)
+
+
+@router.get("/polls/{id}/live")
+async def live_poll(request: Request, id: int):
+    """Server-sent events with the poll's vote counts, sent again after each ballot"""
+    # Sessions are scoped by hand so a long-lived stream doesn't hold a pooled connection
+    async with async_session_scope() as db:
+        if await crud.get_tally(db, id) is None:
+            raise HTTPException(status_code=404, detail="Poll not found")
+    return StreamingResponse(
+        _tally_events(request, id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.post("/polls/{id}", response_class=RedirectResponse)
 async def submit_poll(
-    request: Request, id: int, user: str = Form(...), db: Session = Depends(get_db)
+    request: Request, id: int, user: str = Form(...), db: AsyncSession = Depends(get_async_db)
 ):
     formdata = await request.form()
 
@@ -146,8 +285,8 @@ async def submit_poll(
                 map(lambda x: (x[0], len(choice_values) + 1 - x[1]), choice_values)
             )
 
-    for choice_id, votes in choice_values:
-        crud.update_vote(db, choice_id, votes)
-    crud.update_voters(db, id, user)
+    tally = await crud.submit_ballot(db, id, user, choice_values)
+    if tally is not None:
+        live.broadcaster.publish(id, tally)
 
-    return RedirectResponse(url="/bookclub", status_code=303)
+    return RedirectResponse(url=f"/bookclub/polls/{id}/results", status_code=303)
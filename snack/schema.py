@@ -2,12 +2,6 @@ from datetime import datetime
 
 from email_validator import EmailNotValidError, validate_email
 from pydantic import BaseModel, Field, HttpUrl, validator
-from sqlalchemy import select
-
-from snack import models
-from snack.database import SessionLocal
-
-db = SessionLocal()
 
 
 class UserBase(BaseModel):
@@ -31,16 +25,12 @@ class UserCreate(UserInfo):
     def username_valid(cls, v):
         if len(v) < 2 or len(v) > 20:
             raise ValueError("Username must be between 2 and 20 characters")
-        if db.execute(select(models.User.username).where(models.User.username == v)).scalar():
-            raise ValueError("Username already exists")
         return v
 
     @validator("email")
     def email_valid(cls, v):
         try:
             validate_email(v)
-            if db.execute(select(models.User.email).where(models.User.email == v)).scalar():
-                raise ValueError("Email already exists")
             return v
         except EmailNotValidError:
             raise ValueError("Email is not valid")
@@ -64,6 +54,16 @@ class User(UserBase):
         orm_mode = True
 
 
+class Principal(UserBase):
+    """Authenticated user, detached from the session so it can be cached"""
+
+    id: int
+    scopes: list[str] = []
+
+    class Config:
+        orm_mode = True
+
+
 class PostBase(BaseModel):
     title: str
     date_posted: datetime = datetime.today().strftime("%Y-%m-%d")
@@ -89,6 +89,33 @@ class PostInfo(PostBase):
         orm_mode = True
 
 
+class Tag(BaseModel):
+    name: str
+
+    class Config:
+        orm_mode = True
+
+
+class PostPage(BaseModel):
+    """Detached snapshot of a post used to render the post page"""
+
+    id: int
+    title: str
+    slug: str
+    date_posted: datetime
+    description: str = None
+    image_text: str = None
+    photographer_name: str = None
+    photographer_url: str = None
+    keywords: str = None
+    image_variants: dict = None
+    author: User
+    tags: list[Tag] = []
+
+    class Config:
+        orm_mode = True
+
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -0,0 +1,74 @@
+import os
+
+from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+
+from snack import config
+from snack.assets import static_url
+from snack.cache import fragment_cache
+from snack.images import srcset
+
+TEMPLATE_DIR = "templates"
+
+
+class Fragment:
+    """
+    Part of a page kept in the fragment cache, looked up by the route before it queries what the
+    part shows, so a hit skips the queries as well as the rendering\n
+    Values the rest of the page takes from the same queries, like the next page's URL, go in
+    `data` and are cached along with the HTML
+    """
+
+    def __init__(self, key: str, version: int, ttl: int = None):
+        # The version is part of the key, so a write strands old fragments for the LRU to evict
+        self.key = (version, key)
+        self.ttl = config.FRAGMENT_CACHE_TTL if ttl is None else ttl
+        cached = fragment_cache.get(self.key)
+        self.html, self.data = cached if cached is not None else (None, {})
+
+    @property
+    def missing(self) -> bool:
+        return self.html is None
+
+    def render(self, caller) -> str:
+        if self.html is None:
+            self.html = caller()
+            fragment_cache.set(self.key, (self.html, self.data), self.ttl)
+        return self.html
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Adds {% cache fragment %}...{% endcache %}, which renders its body only when the Fragment
+    passed by the route wasn't found in the cache
+    """
+
+    tags = {"cache"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        body = parser.parse_statements(["name:endcache"], drop_needle=True)
+        return nodes.CallBlock(self.call_method("_render", args), [], [], body).set_lineno(lineno)
+
+    def _render(self, fragment: Fragment, caller):
+        return fragment.render(caller)
+
+
+# Shared by the app and its routers so each worker compiles and caches templates once
+templates = Jinja2Templates(directory=TEMPLATE_DIR)
+templates.env.filters["srcset"] = srcset
+templates.env.globals["static_url"] = static_url
+templates.env.add_extension(FragmentCacheExtension)
+# Checking templates for changes on every render is only wanted while editing them
+templates.env.auto_reload = config.DEBUG
+os.makedirs(config.TEMPLATE_CACHE_DIR, exist_ok=True)
+templates.env.bytecode_cache = FileSystemBytecodeCache(config.TEMPLATE_CACHE_DIR)
+
+
+def precompile():
+    """Loads every template at startup, so no request pays for compiling one.
+    Bytecode from a previous run is reused for templates that haven't changed."""
+    for name in templates.env.list_templates(extensions=["html"]):
+        templates.env.get_template(name)
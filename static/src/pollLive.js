@@ -0,0 +1,36 @@
+$(function () {
+  const results = document.getElementById("poll-results");
+  const source = new EventSource(
+    `/bookclub/polls/${results.dataset.pollId}/live`
+  );
+
+  function setVotes(choiceId, votes) {
+    const item = results.querySelector(`[data-choice-id="${choiceId}"]`);
+    if (item) {
+      item.dataset.votes = votes;
+      item.querySelector(".votes").textContent = votes;
+    }
+  }
+
+  function sortResults() {
+    Array.from(results.children)
+      .sort((a, b) => Number(b.dataset.votes) - Number(a.dataset.votes))
+      .forEach((item) => results.appendChild(item));
+  }
+
+  // Ballots counted in the newest tally shown, so one arriving late doesn't undo it
+  let ballots = -1;
+
+  // Absolute vote counts, sent on connecting and again after each ballot
+  source.addEventListener("tally", function (e) {
+    const tally = JSON.parse(e.data);
+    if (tally.ballots < ballots) {
+      return;
+    }
+    ballots = tally.ballots;
+    for (const [choiceId, votes] of Object.entries(tally.votes)) {
+      setVotes(choiceId, votes);
+    }
+    sortResults();
+  });
+});